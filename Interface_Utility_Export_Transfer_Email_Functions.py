@@ -16,6 +16,29 @@ import importlib.util
 import gnupg
 import subprocess
 import json
+import csv
+import threading
+import hashlib
+import io
+import gzip
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from metrics import stage, add_to_stage
+from arrow_types import arrow_type_for
+from contextlib import contextmanager
+
+# Rows fetched per cursor.fetchmany() call by the streaming exporter
+DEFAULT_EXPORT_BATCH_SIZE = 50000
+
+# Rows per worksheet in an .xlsx file (header row included)
+EXCEL_MAX_ROWS = 1048576
+
+# script_config['compression'] for CSV/TXT exports and the suffix it adds to the file name
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+
+# Resumable SFTP uploads write to "<name>.part" and rename it once the upload is verified
+RESUMABLE_UPLOAD_SUFFIX = '.part'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 # Load the configuration from the specified file
 # Load the configuration from a JSON file
@@ -58,69 +81,219 @@ def decrypt_password(encrypted_password, cipher):
     return cipher.decrypt(encrypted_password.encode()).decode()
 
 
+# ---- Skipping exports whose data did not change ----
+
+# Fingerprints of the last export of every query, kept in script_config['fingerprint_file']
+# (default export_fingerprints.json in the backup folder)
+_fingerprint_lock = threading.Lock()
+
+
+def fingerprint_file_path(script_config, backup_folder):
+    return script_config.get('fingerprint_file') or os.path.join(backup_folder, 'export_fingerprints.json')
+
+
+def load_export_fingerprints(fingerprint_file):
+    if not os.path.exists(fingerprint_file):
+        return {}
+    with open(fingerprint_file, 'r') as f:
+        return json.load(f)
+
+
+def save_export_fingerprint(fingerprint_file, key, fingerprint):
+    with _fingerprint_lock:
+        fingerprints = load_export_fingerprints(fingerprint_file)
+        fingerprints[key] = {'fingerprint': fingerprint, 'exported_at': datetime.now().isoformat()}
+        tmp_file = f"{fingerprint_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(fingerprints, f, indent=2)
+        os.replace(tmp_file, fingerprint_file)
+
+
+# Cursor wrapper that hashes the rows fetched through it (a rolling SHA-256 over every
+# fetched batch), so an export can tell afterwards whether it wrote the same data as last time
+class FingerprintingCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._digest = hashlib.sha256()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _update(self, rows):
+        self._digest.update(repr(rows).encode())
+        return rows
+
+    def fetchmany(self, size):
+        return self._update(self._cursor.fetchmany(size))
+
+    def fetchall(self):
+        return self._update(self._cursor.fetchall())
+
+    def hexdigest(self):
+        columns = [desc[0] for desc in self._cursor.description or []]
+        return hashlib.sha256(repr(columns).encode() + self._digest.digest()).hexdigest()
+
+
+# With skip_unchanged_exports=Y: drop a just-written export that holds the same data as the
+# previous export of the query, so it is not encrypted, uploaded and mailed again.
+# Returns True when the file was unchanged and removed.
+def discard_unchanged_export(file_path, key, fingerprint, fingerprint_file):
+    previous = load_export_fingerprints(fingerprint_file).get(key, {}).get('fingerprint')
+    if previous == fingerprint:
+        for path in (file_path, file_path + '.gpg'):
+            if os.path.exists(path):
+                os.remove(path)
+        logging.info(f"{os.path.basename(file_path)} holds the same data as the previous export. Skipping it.")
+        return True
+    save_export_fingerprint(fingerprint_file, key, fingerprint)
+    return False
+
+
+# Export a single procedure/view. Returns a dict with the filename and a status of
+# 'exported', 'skipped', 'unchanged' (same data as the previous export, file removed),
+# 'executed' (procedure that writes its own file) or 'failed'.
+def export_query(cursor, item, file_prefix, query_name, script_config, from_date_str, to_date_str, data_folder, backup_folder):
+    date_format = script_config.get('date_format', '%m%d%Y')
+    # Generate filename based on the prefix and date range
+    extension = script_config.get('extension', 'csv')
+    # Parse the from and to dates
+    from_date = parse_date(from_date_str, date_format) if from_date_str else None
+    to_date = parse_date(to_date_str, date_format) if to_date_str else None
+    suffix = compression_suffix(script_config, extension)
+    filename = generate_filename(file_prefix, from_date, to_date, extension, script_config) + suffix
+    file_path = os.path.join(data_folder, filename)
+    backup_file_path = os.path.join(backup_folder, filename)
+
+    # Skip the file if it already exists
+    if os.path.exists(file_path) or os.path.exists(backup_file_path):
+        logging.info(f"File {filename} already exists. Skipping export.")
+        return {'status': 'skipped', 'filename': filename}
+
+    skip_unchanged = script_config.get('skip_unchanged_exports', 'N').upper() == 'Y'
+    fingerprint_key = f"{item}:{file_prefix}"
+    if skip_unchanged:
+        cursor = FingerprintingCursor(cursor)
+
+    try:
+        # Execute procedure or view query based on item type
+        if item == 'procedures':
+            # The procedure writes a plain file, which is compressed afterwards
+            procedure_path = file_path[:-len(suffix)] if suffix else file_path
+            query = f'CALL dba.{query_name}(?, ?, ?);'  # Pass filename and date arguments
+            with stage('sybase_execute', query=query_name):
+                cursor.execute(query, (procedure_path, from_date, to_date))
+
+            # Export results to file
+            if extension == 'xlsx':
+                with stage('export_write', query=query_name) as write_stage:
+                    export_data_to_file(cursor, file_path, extension, script_config)
+                    write_stage['bytes'] = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+
+            if skip_unchanged and os.path.exists(procedure_path):
+                # The procedure writes the file itself: fingerprint the file (xlsx: the rows)
+                if extension == 'xlsx':
+                    fingerprint = cursor.hexdigest()
+                else:
+                    fingerprint = local_checksum(procedure_path, os.path.getsize(procedure_path)).hex()
+                if discard_unchanged_export(procedure_path, fingerprint_key, fingerprint, fingerprint_file_path(script_config, backup_folder)):
+                    return {'status': 'unchanged', 'filename': filename}
+            if suffix and os.path.exists(procedure_path):
+                compress_file(procedure_path, file_path, script_config)
+            return {'status': 'executed', 'filename': filename}
+        elif item == 'views':
+            query = f'SELECT * FROM dba.{query_name};'
+            with stage('sybase_execute', query=query_name):
+                cursor.execute(query)
+            with stage('export_write', query=query_name) as write_stage:
+                export_success = export_data_to_file(cursor, file_path, extension, script_config)
+                write_stage['bytes'] = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+
+            if export_success and skip_unchanged and discard_unchanged_export(
+                    file_path, fingerprint_key, cursor.hexdigest(), fingerprint_file_path(script_config, backup_folder)):
+                return {'status': 'unchanged', 'filename': filename}
+            if export_success:
+                logging.info(f'{filename} successfully exported at the "{data_folder}" path.')
+                return {'status': 'exported', 'filename': filename}
+            else:
+                logging.info(f'{filename} was not exported (0 rows and allow_empty_export=N).')
+                return {'status': 'skipped', 'filename': filename}
+
+    except pyodbc.Error as e:
+        # Handle query execution errors
+        logging.error(f"File Export Error: {e}")
+        return {'status': 'failed', 'filename': filename, 'error': f"Failed to export file: {filename} due to database error."}
+
+    except Exception as e:
+        logging.error(f"File Export Error: {e}")
+        return {'status': 'failed', 'filename': filename, 'error': f"Failed to export file: {filename} {e}"}
+
+
+# Run export jobs on max_workers threads. Every worker opens its own connection through
+# connection_factory on first use; all connections are closed once the jobs are done.
+def run_exports_parallel(jobs, connection_factory, max_workers, export_args):
+    worker_state = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+
+    def run_job(job):
+        item, file_prefix, query_name = job
+        try:
+            if getattr(worker_state, 'cursor', None) is None:
+                conn = connection_factory()
+                with connections_lock:
+                    connections.append(conn)
+                worker_state.cursor = conn.cursor()
+            return export_query(worker_state.cursor, item, file_prefix, query_name, *export_args)
+        except Exception as e:
+            logging.error(f"File Export Error: {e}")
+            return {'status': 'failed', 'filename': file_prefix, 'error': f"Failed to export file for {query_name}: {e}"}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export") as executor:
+            return list(executor.map(run_job, jobs))
+    finally:
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logging.error(f"Error closing export connection: {e}")
+
+
 # Connect to the database and execute queries
-def execute_queries(cursor, script_config, from_date_str, to_date_str, data_folder, backup_folder):
+# With script_config['max_parallel_exports'] > 1 and a connection_factory, the exports of
+# the interface run concurrently, each worker on its own connection.
+def execute_queries(cursor, script_config, from_date_str, to_date_str, data_folder, backup_folder, connection_factory=None):
     error_messages = []
     file_export_successful = True
-    date_format = script_config.get('date_format', '%m%d%Y')
     exported_file_count = 0     # Counter for the number of files exported
     exported_files = []
     skip_file_count = 0
 
-    # Iterate over each item in the script execution order
+    # Collect every file to export, following the script execution order
+    jobs = []
     for item in script_config['execution_order']:
         item = item.lower()
 
         if item in script_config:
             for file_prefix, query_name in script_config[item].items():
-                # Generate filename based on the prefix and date range
-                extension = script_config.get('extension', 'csv')
-                # Parse the from and to dates
-                from_date = parse_date(from_date_str, date_format) if from_date_str else None
-                to_date = parse_date(to_date_str, date_format) if to_date_str else None
-                filename = generate_filename(file_prefix, from_date, to_date, extension, script_config)
-                file_path = os.path.join(data_folder, filename)
-                backup_file_path = os.path.join(backup_folder, filename)
-                
-                # Skip the file if it already exists
-                if os.path.exists(file_path) or os.path.exists(backup_file_path):
-                    logging.info(f"File {filename} already exists. Skipping export.")
-                    skip_file_count += 1
-                    continue  # Move to the next file if it exists
+                jobs.append((item, file_prefix, query_name))
 
-                try:
-                    # Execute procedure or view query based on item type
-                    if item == 'procedures':
-                        query = f'CALL dba.{query_name}(?, ?, ?);'  # Pass filename and date arguments
-                        cursor.execute(query, (file_path, from_date, to_date))
-
-                        # Export results to file
-                        if extension == 'xlsx':
-                            export_data_to_file(cursor, file_path, extension, script_config)
-                    elif item == 'views':
-                        query = f'SELECT * FROM dba.{query_name};'
-                        cursor.execute(query)
-                        export_success = export_data_to_file(cursor, file_path, extension, script_config)
-
-                        if export_success:
-                            logging.info(f'{filename} successfully exported at the "{data_folder}" path.')
-                            exported_file_count += 1
-                            exported_files.append(filename)
-                        else:
-                            logging.info(f'{filename} was not exported (0 rows and allow_empty_export=N).')
-                            skip_file_count += 1
-                        
-
-                except pyodbc.Error as e:
-                    # Handle query execution errors
-                    error_messages.append(f"Failed to export file: {filename} due to database error.")
-                    logging.error(f"File Export Error: {e}")
-                    file_export_successful = False
-
-                except Exception as e:
-                    error_messages.append(f"Failed to export file: {filename} {e}")
-                    logging.error(f"File Export Error: {e}")
-                    file_export_successful = False
+    export_args = (script_config, from_date_str, to_date_str, data_folder, backup_folder)
+    max_parallel = int(script_config.get('max_parallel_exports', 1))
+    if max_parallel > 1 and connection_factory is not None and len(jobs) > 1:
+        results = run_exports_parallel(jobs, connection_factory, max_parallel, export_args)
+    else:
+        results = [export_query(cursor, item, file_prefix, query_name, *export_args) for item, file_prefix, query_name in jobs]
+
+    for result in results:
+        if result['status'] == 'exported':
+            exported_file_count += 1
+            exported_files.append(result['filename'])
+        elif result['status'] in ('skipped', 'unchanged'):
+            skip_file_count += 1
+        elif result['status'] == 'failed':
+            error_messages.append(result['error'])
+            file_export_successful = False
 
     return error_messages, file_export_successful, exported_file_count, exported_files, skip_file_count
 
@@ -174,56 +347,409 @@ def parse_date(date_str, date_format):
             exit()
 
 
-def export_files(df, file_path, quote_style, extension, separator = None):
+def export_files(df, file_path, quote_style, extension, separator = None, parquet_compression = 'snappy', compression = None):
     quoting = 1 if quote_style == '"' else 3        # 1: QUOTE_ALL for double quotes, 3: QUOTE_NONE for single quotes
     escapechar = '\\' 
     if extension == 'xlsx':                            # handle excel export
         df.to_excel(file_path, index = False, engine = 'openpyxl')
+    elif extension == 'parquet':                       # handle parquet export (needs pyarrow)
+        df.to_parquet(file_path, index = False, compression = parquet_compression)
     elif extension == 'csv':                           # handle csv export
-        df.to_csv(file_path, index = False, quoting = quoting, sep = separator, escapechar = escapechar)
+        df.to_csv(file_path, index = False, quoting = quoting, sep = separator, escapechar = escapechar, compression = compression)
     elif extension == 'txt':
         sep = separator if separator else '\t'
-        df.to_csv(file_path, index=False, sep = sep, lineterminator = '\n', quoting = quoting, escapechar = escapechar)
+        df.to_csv(file_path, index=False, sep = sep, lineterminator = '\n', quoting = quoting, escapechar = escapechar, compression = compression)
     else:
-        logging.error(f"Unsupported file format: {extension} for file: {file_path}. Supported formats are xlsx, csv, txt.")
+        logging.error(f"Unsupported file format: {extension} for file: {file_path}. Supported formats are xlsx, csv, txt, parquet.")
         return False
     
     return True
 
 
 
-# Export the query result to a file (CSV or XLSX)
-def export_data_to_file(cursor, file_path, extension, script_config):
-    rows = cursor.fetchall()        # Fetch all rows from the cursor
+# csv.writer settings matching what export_files passes to DataFrame.to_csv
+def csv_writer_options(quote_style, extension, separator=None):
+    if extension == 'txt':
+        separator = separator if separator else '\t'
+        lineterminator = '\n'
+    else:
+        lineterminator = os.linesep     # DataFrame.to_csv default
+    return {
+        'delimiter': separator,
+        'quoting': csv.QUOTE_ALL if quote_style == '"' else csv.QUOTE_NONE,
+        'escapechar': '\\',
+        'lineterminator': lineterminator,
+    }
+
+
+# Column names and first rows of a query result (the first batch_size rows, all of them
+# without batch_size), or None when there is nothing to export: no columns, or no rows and
+# allow_empty_export is not Y. With allow_empty_export=Y an empty result gives ([...], []).
+def fetch_first_export_rows(cursor, file_path, script_config, batch_size=None):
     columns = [desc[0] for desc in cursor.description]      # Get column names
-
     allow_empty = script_config.get("allow_empty_export", "N").upper()
 
     if not columns:
         logging.error(f"No columns found in the query result for {file_path}.")
-        return False
+        return None
 
+    rows = cursor.fetchmany(batch_size) if batch_size else cursor.fetchall()
     if not rows:  # 0 rows case
         if allow_empty == "Y":
             logging.info(f"Query returned 0 rows. Exporting headers only to {file_path}.")
-            df = pd.DataFrame(columns=columns)   # empty DataFrame, just headers
-            quote_style = script_config.get('quote_style', "'")
-            separator = script_config.get('separator', ',')
-            export_files(df, file_path, quote_style, extension, separator)
-            return True
         else:
             logging.info(f"Query returned 0 rows. Skipping export for {file_path} (per config).")
-            return False
+            return None
+    return columns, rows
+
+
+# Never leave a partial file behind for the encryption/transfer steps to pick up: remove the
+# export (and its streamed .gpg) when writing it fails
+@contextmanager
+def removing_partial_export(file_path):
+    try:
+        yield
+    except Exception:
+        for path in (file_path, file_path + '.gpg'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+
+# Stream the query result straight into a CSV/TXT file, one fetchmany() batch at a time,
+# so memory use does not grow with the size of the result set
+def export_cursor_to_file(cursor, file_path, extension, script_config, batch_size=DEFAULT_EXPORT_BATCH_SIZE):
+    first_rows = fetch_first_export_rows(cursor, file_path, script_config, batch_size)
+    if first_rows is None:
+        return False
+    columns, rows = first_rows
+
+    quote_style = script_config.get('quote_style', "'")
+    separator = script_config.get('separator', ',')
+    row_count = 0
+    with removing_partial_export(file_path):
+        with open_export_file(file_path, script_config, compress=True) as f:
+            writer = csv.writer(f, **csv_writer_options(quote_style, extension, separator))
+            writer.writerow(columns)
+            while rows:
+                writer.writerows(rows)
+                row_count += len(rows)
+                rows = cursor.fetchmany(batch_size)
+
+    add_to_stage(rows=row_count)
+    logging.info(f"Streamed {row_count} rows to {file_path}.")
+    return True
+
+
+# Stream the query result into a Parquet file, one row group per fetchmany() batch. The
+# column types come from cursor.description, so NULL-only batches keep the right schema.
+def export_cursor_to_parquet(cursor, file_path, script_config, batch_size=DEFAULT_EXPORT_BATCH_SIZE):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    description = cursor.description
+    first_rows = fetch_first_export_rows(cursor, file_path, script_config, batch_size)
+    if first_rows is None:
+        return False
+    columns, rows = first_rows
+
+    types = [arrow_type_for(pa, desc[1], desc[4], desc[5]) for desc in description]
+    row_count = 0
+    with removing_partial_export(file_path):
+        with open_export_file(file_path, script_config, binary=True) as f:
+            writer = None
+            while rows or writer is None:
+                arrays = [pa.array(values, type=arrow_type) for values, arrow_type in zip(zip(*rows), types)] if rows else \
+                         [pa.array([], type=arrow_type or pa.null()) for arrow_type in types]
+                table = pa.Table.from_arrays(arrays, names=columns)
+                if writer is None:
+                    writer = pq.ParquetWriter(f, table.schema, compression=script_config.get('parquet_compression', 'snappy'))
+                writer.write_table(table.cast(writer.schema))
+                row_count += len(rows)
+                rows = cursor.fetchmany(batch_size)
+            writer.close()
+
+    add_to_stage(rows=row_count)
+    logging.info(f"Streamed {row_count} rows to {file_path}.")
+    return True
+
+
+# Stream the query result into an .xlsx workbook with openpyxl's write-only mode, one
+# fetchmany() batch at a time. Rows beyond Excel's sheet limit continue on a new sheet
+# (Sheet1, Sheet2, ...) that repeats the header row.
+def export_cursor_to_xlsx(cursor, file_path, script_config, batch_size=DEFAULT_EXPORT_BATCH_SIZE):
+    from openpyxl import Workbook
+
+    first_rows = fetch_first_export_rows(cursor, file_path, script_config, batch_size)
+    if first_rows is None:
+        return False
+    columns, rows = first_rows
+
+    workbook = Workbook(write_only=True)
+    sheet_count = 0
+    sheet_rows = EXCEL_MAX_ROWS     # forces the first sheet to be created
+    row_count = 0
+    with removing_partial_export(file_path):
+        while True:
+            for row in rows:
+                if sheet_rows >= EXCEL_MAX_ROWS:
+                    sheet_count += 1
+                    sheet = workbook.create_sheet(f"Sheet{sheet_count}")
+                    sheet.append(columns)
+                    sheet_rows = 1
+                sheet.append(list(row))
+                sheet_rows += 1
+            row_count += len(rows)
+            if sheet_count == 0:     # headers only
+                workbook.create_sheet("Sheet1").append(columns)
+                sheet_count = 1
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+
+        with open_export_file(file_path, script_config, binary=True) as f:
+            workbook.save(f)
+
+    add_to_stage(rows=row_count)
+    logging.info(f"Streamed {row_count} rows to {file_path} ({sheet_count} sheet(s)).")
+    return True
+
+
+# ---- Compression of CSV/TXT exports ----
+
+# Compression method and level from script_config; (None, None) when compression is off
+def compression_settings(script_config):
+    method = (script_config.get('compression') or 'none').lower()
+    if method == 'none':
+        return None, None
+    if method not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unsupported compression '{method}'. Supported methods are none, {', '.join(COMPRESSION_SUFFIXES)}.")
+    return method, int(script_config.get('compression_level', DEFAULT_COMPRESSION_LEVELS[method]))
+
+
+# Suffix compression adds to export file names ('.gz', '.zst'); only CSV/TXT are compressed,
+# xlsx and parquet files are compressed containers already
+def compression_suffix(script_config, extension=None):
+    method, _ = compression_settings(script_config)
+    if method is None or (extension or script_config.get('extension', 'csv')) not in ('csv', 'txt'):
+        return ''
+    return COMPRESSION_SUFFIXES[method]
+
+
+# Ending of the export files of an interface (e.g. '.csv.gz'), used to pick them up for
+# encryption and transfer
+def export_file_suffix(script_config):
+    extension = script_config.get('extension', 'csv')
+    return f".{extension}{compression_suffix(script_config, extension)}"
+
+
+# DataFrame.to_csv compression argument for script_config
+def pandas_compression(script_config):
+    method, level = compression_settings(script_config)
+    if method == 'gzip':
+        return {'method': 'gzip', 'compresslevel': level}
+    if method == 'zstd':
+        return {'method': 'zstd', 'level': level}
+    return None
+
+
+# gpg compresses its input by default; already compressed exports are encrypted as they are
+def gpg_extra_args(file_path):
+    return ['--compress-algo', 'none'] if file_path.endswith(tuple(COMPRESSION_SUFFIXES.values())) else None
+
 
-    # Normal case: rows exist
+# GzipFile that also closes the stream it writes to
+class ClosingGzipFile(gzip.GzipFile):
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+# Binary stream compressing everything written to it into raw (closed along with it)
+def compressing_stream(raw, script_config):
+    method, level = compression_settings(script_config)
+    if method == 'gzip':
+        return ClosingGzipFile(fileobj=raw, mode='wb', compresslevel=level)
+    import zstandard        # optional dependency, only for compression=zstd
+    return io.BufferedWriter(zstandard.ZstdCompressor(level=level).stream_writer(raw))
+
+
+# Compress a file written by a procedure into target_path and remove the original
+def compress_file(file_path, target_path, script_config):
+    with stage('compression') as compression_stage:
+        compression_stage['bytes'] = os.path.getsize(file_path)
+        try:
+            with open(file_path, 'rb') as source, compressing_stream(open(target_path, 'wb'), script_config) as target:
+                shutil.copyfileobj(source, target, UPLOAD_CHUNK_SIZE)
+        except Exception:
+            if os.path.exists(target_path):
+                os.remove(target_path)
+            raise
+    os.remove(file_path)
+    logging.info(f"Compressed {os.path.basename(file_path)} -> {os.path.basename(target_path)}")
+
+
+# Open the stream the streaming exporter writes to (text, or bytes with binary=True).
+# With stream_encryption=Y (and encrypt_files=Y) the same bytes are also piped into gpg
+# while the file is written. With compress=True and a compression method configured the
+# data is compressed on the way, before it is written (and encrypted).
+def open_export_file(file_path, script_config, binary=False, compress=False):
+    if script_config.get('encrypt_files', 'N').upper() == 'Y' and script_config.get('stream_encryption', 'N').upper() == 'Y':
+        raw = EncryptingWriter(file_path, script_config)
+    else:
+        raw = io.FileIO(file_path, 'wb')
+    if compress and compression_settings(script_config)[0] is not None:
+        stream = compressing_stream(raw, script_config)
+    else:
+        stream = io.BufferedWriter(raw)
+    return stream if binary else io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+
+# Export the query result to a file (CSV or XLSX)
+def export_data_to_file(cursor, file_path, extension, script_config):
+    if extension in ('csv', 'txt') and script_config.get('stream_export', 'N').upper() == 'Y':
+        batch_size = int(script_config.get('export_batch_size', DEFAULT_EXPORT_BATCH_SIZE))
+        return export_cursor_to_file(cursor, file_path, extension, script_config, batch_size)
+    if extension == 'parquet' and script_config.get('stream_export', 'N').upper() == 'Y':
+        batch_size = int(script_config.get('export_batch_size', DEFAULT_EXPORT_BATCH_SIZE))
+        return export_cursor_to_parquet(cursor, file_path, script_config, batch_size)
+    if extension == 'xlsx' and script_config.get('stream_export', 'N').upper() == 'Y':
+        batch_size = int(script_config.get('export_batch_size', DEFAULT_EXPORT_BATCH_SIZE))
+        return export_cursor_to_xlsx(cursor, file_path, script_config, batch_size)
+
+    first_rows = fetch_first_export_rows(cursor, file_path, script_config)
+    if first_rows is None:
+        return False
+    columns, rows = first_rows
+
+    # Without rows this writes the headers only
+    add_to_stage(rows=len(rows))
     rows = [list(row) for row in rows]
     df = pd.DataFrame(rows, columns=columns)
     quote_style = script_config.get('quote_style', "'")
     separator = script_config.get('separator', ',')
-    export_files(df, file_path, quote_style, extension, separator)
+    with removing_partial_export(file_path):
+        export_files(df, file_path, quote_style, extension, separator, script_config.get('parquet_compression', 'snappy'),
+                     pandas_compression(script_config))
 
     return True
         
+# gnupg.GPG instance and imported recipient fingerprints, shared by every encryption in the
+# process so the public key is imported only once per key file version
+_gpg = None
+_recipient_fingerprints = {}
+_gpg_lock = threading.Lock()
+
+
+def get_gpg():
+    global _gpg
+    with _gpg_lock:
+        if _gpg is None:
+            _gpg = gnupg.GPG()#.GPG(binary=gpg_path, homedir=gpg_home, ignore_homedir_permissions=True)
+        return _gpg
+
+
+# Import the public key (once per path and modification time) and return the fingerprint of
+# the first imported key, or None when the import failed
+def get_recipient_fingerprint(gpg, public_key_path):
+    cache_key = (public_key_path, os.path.getmtime(public_key_path))
+    with _gpg_lock:
+        if cache_key in _recipient_fingerprints:
+            return _recipient_fingerprints[cache_key]
+
+        with open(public_key_path, 'rb') as f:
+            import_result = gpg.import_keys(f.read())
+        if not import_result.count:
+            logging.error("Failed to import public key.")
+            return None
+
+        logging.info(f"Public key imported. Fingerprints: {import_result.fingerprints}")
+        _recipient_fingerprints[cache_key] = import_result.fingerprints[0]
+        return import_result.fingerprints[0]
+
+
+# An encrypted file is up to date when it is at least as new as its source file
+def is_encryption_up_to_date(file_path, encrypted_path):
+    return os.path.exists(encrypted_path) and os.path.getmtime(encrypted_path) >= os.path.getmtime(file_path)
+
+
+def encrypt_file(gpg, file_path, recipient_key):
+    filename = os.path.basename(file_path)
+    encrypted_path = file_path + ".gpg"
+    try:
+        with stage('encryption') as encryption_stage, open(file_path, 'rb') as f:
+            encryption_stage['bytes'] = os.path.getsize(file_path)
+            status = gpg.encrypt_file(
+                f,
+                recipients=[recipient_key],
+                output=encrypted_path,
+                always_trust=True,
+                extra_args=gpg_extra_args(file_path)
+            )
+
+        if status.ok:
+            logging.info(f"Encrypted {filename} -> {encrypted_path}")
+            return True, encrypted_path
+        logging.error(f"Encryption failed for {filename}: {status.status}")
+    except Exception as e:
+        logging.error(f"Exception encrypting {filename}: {e}")
+    return False, encrypted_path
+
+
+# Raw binary stream that writes everything to file_path and, at the same time, feeds it
+# through a pipe into gpg, which writes file_path + '.gpg'. close() waits for gpg and
+# raises if the encryption failed.
+class EncryptingWriter(io.RawIOBase):
+    def __init__(self, file_path, script_config):
+        gpg = get_gpg()
+        recipient_key = get_recipient_fingerprint(gpg, script_config['pgp_key_file_path'])
+        if recipient_key is None:
+            raise Exception("GPG public key import failed.")
+
+        self.file_path = file_path
+        self.encrypted_path = file_path + ".gpg"
+        self.plain_file = open(file_path, 'wb')
+        read_fd, write_fd = os.pipe()
+        self.pipe = os.fdopen(write_fd, 'wb')
+        self.status = None
+        self.error = None
+
+        def encrypt():
+            try:
+                with os.fdopen(read_fd, 'rb') as pipe_in:
+                    self.status = gpg.encrypt_file(pipe_in, recipients=[recipient_key], output=self.encrypted_path,
+                                                   always_trust=True, extra_args=gpg_extra_args(file_path))
+            except Exception as e:
+                self.error = e
+
+        self.encrypt_thread = threading.Thread(target=encrypt, name="gpg-stream", daemon=True)
+        self.encrypt_thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.plain_file.write(data)
+        self.pipe.write(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.plain_file.close()
+        self.pipe.close()
+        self.encrypt_thread.join()
+        if self.error is not None or not (self.status and self.status.ok):
+            reason = self.error if self.error is not None else getattr(self.status, 'status', None)
+            raise Exception(f"Streaming encryption failed for {os.path.basename(self.file_path)}: {reason}")
+        logging.info(f"Encrypted {os.path.basename(self.file_path)} -> {self.encrypted_path} while exporting")
+
+
 def encrypt_files_with_gnupg(data_folder, script_config):
     # Setup logging
     logging.basicConfig(level=logging.INFO)
@@ -238,52 +764,49 @@ def encrypt_files_with_gnupg(data_folder, script_config):
     # # Set environment variable to define GPG home
     # os.environ['GNUPGHOME'] = gpg_home
 
-    # Initialize GPG
-    gpg = gnupg.GPG()#.GPG(binary=gpg_path, homedir=gpg_home, ignore_homedir_permissions=True)
+    # Initialize GPG (shared across runs in this process)
+    gpg = get_gpg()
 
     # Import the public key
     try:
-        with open(public_key_path, 'rb') as f:
-            import_result = gpg.import_keys(f.read())
-            if not import_result.count:
-                logging.error("Failed to import public key.")
-                return False, []
-            else:
-                logging.info(f"Public key imported. Fingerprints: {import_result.fingerprints}")
+        recipient_key = get_recipient_fingerprint(gpg, public_key_path)
+        if recipient_key is None:
+            return False, []
     except Exception as e:
         logging.error(f"Error importing public key: {e}")
         return False, []
 
     # Use the first available key from the keyring for encryption
-    recipient_key = import_result.fingerprints[0]
     logging.info(f"Using recipient key with fingerprint: {recipient_key} for encryption.")
 
-    # Encrypt files
+    # Encrypt files, skipping the ones whose .gpg output is already up to date
     encrypted_files = []
+    pending_files = []
     for filename in os.listdir(data_folder):
-        if filename.endswith(script_config['extension']):
+        if filename.endswith(export_file_suffix(script_config)):
             file_path = os.path.join(data_folder, filename)
             encrypted_path = file_path + ".gpg"
+            if is_encryption_up_to_date(file_path, encrypted_path):
+                logging.info(f"{encrypted_path} is up to date. Skipping encryption of {filename}.")
+                encrypted_files.append(encrypted_path)
+            else:
+                pending_files.append(file_path)
 
-            try:
-                with open(file_path, 'rb') as f:
-                    status = gpg.encrypt_file(
-                        f,
-                        recipients=[recipient_key],
-                        output=encrypted_path,
-                        always_trust=True
-                    )
-
-                if status.ok:
-                    logging.info(f"Encrypted {filename} -> {encrypted_path}")
-                    encrypted_files.append(encrypted_path)
-                else:
-                    logging.error(f"Encryption failed for {filename}: {status.status}")
-                    return False, []
+    workers = int(script_config.get('encryption_workers', 1))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gpg") as executor:
+            results = list(executor.map(lambda file_path: encrypt_file(gpg, file_path, recipient_key), pending_files))
+    else:
+        results = []
+        for file_path in pending_files:
+            results.append(encrypt_file(gpg, file_path, recipient_key))
+            if not results[-1][0]:
+                break
 
-            except Exception as e:
-                logging.error(f"Exception encrypting {filename}: {e}")
-                return False, []
+    for encrypted, encrypted_path in results:
+        if not encrypted:
+            return False, []
+        encrypted_files.append(encrypted_path)
 
     return True, encrypted_files
 
@@ -313,6 +836,131 @@ def connect_to_sftp(hostname, username, password=None, ppk_file_path=None, port=
         return None
 
 
+# SHA-1 of the first `length` bytes of a remote file, computed by the server through the
+# SFTP "check-file" extension. Returns None when the server does not support it.
+def remote_checksum(ftp_client, remote_path, length):
+    try:
+        with ftp_client.open(remote_path, 'rb') as remote_file:
+            return remote_file.check('sha1', 0, length, 0)
+    except IOError:
+        return None
+
+
+def local_checksum(local_path, length):
+    digest = hashlib.sha1()
+    with open(local_path, 'rb') as local_file:
+        remaining = length
+        while remaining > 0:
+            chunk = local_file.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.digest()
+
+
+# Upload a file so that an interrupted transfer can continue where it stopped. Data goes to
+# "<remote>.part": when that file already exists its size is taken as the resume offset
+# (after checking that its content matches the local file, if the server can checksum it).
+# The upload is verified by size, and by checksum where supported, before the temp file is
+# renamed to its final name, so a partial file is never visible under the real name.
+def upload_file_resumable(ftp_client, local_file_path, remote_file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    filename = os.path.basename(local_file_path)
+    local_size = os.path.getsize(local_file_path)
+    temp_path = remote_file_path + RESUMABLE_UPLOAD_SUFFIX
+
+    try:
+        offset = ftp_client.stat(temp_path).st_size
+    except IOError:
+        offset = 0
+
+    if offset > local_size:
+        offset = 0
+    elif offset:
+        checksum = remote_checksum(ftp_client, temp_path, offset)
+        if checksum is not None and checksum != local_checksum(local_file_path, offset):
+            logging.info(f'Partial upload of {filename} does not match the local file. Restarting from byte 0.')
+            offset = 0
+        else:
+            logging.info(f'Resuming upload of {filename} at byte {offset} of {local_size}.')
+
+    with open(local_file_path, 'rb') as local_file, ftp_client.open(temp_path, 'ab' if offset else 'wb') as remote_file:
+        remote_file.set_pipelined(True)
+        local_file.seek(offset)
+        while True:
+            chunk = local_file.read(chunk_size)
+            if not chunk:
+                break
+            remote_file.write(chunk)
+
+    remote_size = ftp_client.stat(temp_path).st_size
+    if remote_size != local_size:
+        raise IOError(f'Size mismatch after upload of {filename}: local {local_size} bytes, remote {remote_size} bytes')
+
+    checksum = remote_checksum(ftp_client, temp_path, local_size)
+    if checksum is not None and checksum != local_checksum(local_file_path, local_size):
+        ftp_client.remove(temp_path)
+        raise IOError(f'Checksum mismatch after upload of {filename}')
+
+    # Publish the verified upload under its real name
+    try:
+        ftp_client.posix_rename(temp_path, remote_file_path)
+    except IOError:
+        try:
+            ftp_client.remove(remote_file_path)
+        except IOError:
+            pass
+        ftp_client.rename(temp_path, remote_file_path)
+
+
+# Upload one file, resumable when sftp_config['resumable_uploads'] is Y
+def upload_file(ftp_client, local_file_path, remote_file_path, sftp_config):
+    with stage('sftp_upload') as upload_stage:
+        upload_stage['bytes'] = os.path.getsize(local_file_path)
+        if sftp_config.get('resumable_uploads', 'N').upper() == 'Y':
+            upload_file_resumable(ftp_client, local_file_path, remote_file_path)
+        else:
+            ftp_client.put(local_file_path, remote_file_path, confirm=False)
+
+
+# Files in the local directory that have to be uploaded: the .gpg files when encryption
+# is on, otherwise the files with the configured extension
+def select_transfer_files(localdirectory, script_config):
+    filenames = []
+    for filename in os.listdir(localdirectory):
+        if script_config['encrypt_files'] == 'Y' and filename.endswith('.gpg'):
+            filenames.append(filename)
+        elif script_config['encrypt_files'] == 'N' and filename.endswith(export_file_suffix(script_config)):
+            filenames.append(filename)
+    return filenames
+
+
+# Move an uploaded file (and, for an encrypted file, its unencrypted original) to the backup
+# path. Returns the names moved; raises if the uploaded file itself cannot be moved.
+def move_file_to_backup(localdirectory, filename, server_config, script_config):
+    local_file_path = os.path.join(localdirectory, filename)
+    backup_file_path = os.path.join(server_config['backup_path'], filename)
+    shutil.move(local_file_path, backup_file_path)
+    logging.info(f'{filename} moved to backup successfully')
+    moved_files = [filename]
+
+    if script_config['encrypt_files'] == 'Y':
+        # Move original unencrypted file to backup
+        original_filename = filename.rsplit('.', 1)[0]
+        original_file_path = os.path.join(localdirectory, original_filename)
+        original_backup_path = os.path.join(server_config['backup_path'], original_filename)
+
+        if os.path.exists(original_file_path):
+            try:
+                shutil.move(original_file_path, original_backup_path)
+                logging.info(f'{original_filename} (original) moved to backup successfully')
+                moved_files.append(original_filename)
+            except Exception as e:
+                logging.error(f'Failed to move original file {original_filename} to backup. Error: {e}')
+
+    return moved_files
+
+
 # Transfer files via SFTP
 def transfer_files_sftp(localdirectory, ftp_client, server_config, sftp_config, script_config):
     files_uploaded = 0
@@ -324,69 +972,100 @@ def transfer_files_sftp(localdirectory, ftp_client, server_config, sftp_config,
     error_messages = []
 
     try:
-        for filename in os.listdir(localdirectory):
+        for filename in select_transfer_files(localdirectory, script_config):
+            local_file_path = os.path.join(localdirectory, filename)
+            remote_file_path = os.path.join(sftp_config['remotedirectory'], filename)
+
+            try:
+                upload_file(ftp_client, local_file_path, remote_file_path, sftp_config)
+                logging.info(f'{filename} uploaded successfully.')
+                files_uploaded += 1
+                uploaded_files.append(filename)
+
+                # Move the file to the backup directory
+                moved_files = move_file_to_backup(localdirectory, filename, server_config, script_config)
+                backup_files_moved += len(moved_files)
+                backup_files.extend(moved_files)
+            except Exception as e:
+                error_messages.append(f'File {filename} not uploaded over SFTP.')
+                logging.error(f'File {filename} not uploaded over SFTP. Error: {e}')
+                files_not_uploaded += 1
+                failed_files.append(filename)
+    except Exception as e:
+        error_messages.append(f"Error during SFTP file transfer: {e}")
+        logging.error(f"SFTP Error: {e}")
+
+    return files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages
+
+
+# Transfer files via SFTP with several uploads in flight. Every upload worker opens its own
+# SFTP channel over the one SSH transport of ssh_client, and backup moves run on a separate
+# thread so they never hold up the next upload. Returns the same counters and lists as
+# transfer_files_sftp.
+def transfer_files_sftp_parallel(localdirectory, ssh_client, server_config, sftp_config, script_config, max_workers=4):
+    files_uploaded = 0
+    files_not_uploaded = 0
+    backup_files_moved = 0
+    uploaded_files = []
+    failed_files = []
+    backup_files = []
+    error_messages = []
+
+    worker_state = threading.local()
+    sftp_clients = []
+    sftp_clients_lock = threading.Lock()
+
+    def upload(filename):
+        if getattr(worker_state, 'ftp_client', None) is None:
+            worker_state.ftp_client = ssh_client.open_sftp()
+            with sftp_clients_lock:
+                sftp_clients.append(worker_state.ftp_client)
 
-            if script_config['encrypt_files'] == 'Y' and filename.endswith('.gpg'):
-                local_file_path = os.path.join(localdirectory, filename)
-                remote_file_path = os.path.join(sftp_config['remotedirectory'], filename)
+        local_file_path = os.path.join(localdirectory, filename)
+        remote_file_path = os.path.join(sftp_config['remotedirectory'], filename)
+        upload_file(worker_state.ftp_client, local_file_path, remote_file_path, sftp_config)
+        logging.info(f'{filename} uploaded successfully.')
 
+    def record_failure(filename, e):
+        nonlocal files_not_uploaded
+        error_messages.append(f'File {filename} not uploaded over SFTP.')
+        logging.error(f'File {filename} not uploaded over SFTP. Error: {e}')
+        files_not_uploaded += 1
+        failed_files.append(filename)
+
+    try:
+        filenames = select_transfer_files(localdirectory, script_config)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sftp-upload") as uploads, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix="sftp-backup") as backups:
+            upload_futures = {uploads.submit(upload, filename): filename for filename in filenames}
+            backup_futures = {}
+
+            for future in as_completed(upload_futures):
+                filename = upload_futures[future]
                 try:
-                    # Upload encrypted file
-                    ftp_client.put(local_file_path, remote_file_path, confirm=False)
-                    logging.info(f'{filename} uploaded successfully.')
-                    files_uploaded += 1
-                    uploaded_files.append(filename)
-
-                    # Move encrypted file to backup
-                    backup_file_path = os.path.join(server_config['backup_path'], filename)
-                    shutil.move(local_file_path, backup_file_path)
-                    logging.info(f'{filename} moved to backup successfully')
-                    backup_files_moved += 1
-                    backup_files.append(filename)
-
-                    # Move original unencrypted file to backup
-                    original_filename = filename.rsplit('.', 1)[0]
-                    original_file_path = os.path.join(localdirectory, original_filename)
-                    original_backup_path = os.path.join(server_config['backup_path'], original_filename)
-
-                    if os.path.exists(original_file_path):
-                        try:
-                            shutil.move(original_file_path, original_backup_path)
-                            logging.info(f'{original_filename} (original) moved to backup successfully')
-                            backup_files_moved += 1
-                            backup_files.append(original_filename)
-                        except Exception as e:
-                            logging.error(f'Failed to move original file {original_filename} to backup. Error: {e}')
+                    future.result()
                 except Exception as e:
-                    error_messages.append(f'File {filename} not uploaded over SFTP.')
-                    logging.error(f'File {filename} not uploaded over SFTP. Error: {e}')
-                    files_not_uploaded += 1
-                    failed_files.append(filename)
+                    record_failure(filename, e)
+                    continue
 
-            elif script_config['encrypt_files'] == 'N' and filename.endswith(script_config['extension']):
-                local_file_path = os.path.join(localdirectory, filename)
-                remote_file_path = os.path.join(sftp_config['remotedirectory'], filename)
+                files_uploaded += 1
+                uploaded_files.append(filename)
+                # Move the file to the backup directory off the upload path
+                backup_futures[filename] = backups.submit(move_file_to_backup, localdirectory, filename, server_config, script_config)
 
+            for filename, future in backup_futures.items():
                 try:
-                    ftp_client.put(local_file_path, remote_file_path, confirm=False)
-                    logging.info(f'{filename} uploaded successfully.')
-                    files_uploaded += 1
-                    uploaded_files.append(filename)
-
-                    # Move the file to the backup directory
-                    backup_file_path = os.path.join(server_config['backup_path'], filename)
-                    shutil.move(local_file_path, backup_file_path)
-                    logging.info(f'{filename} moved to backup successfully')
-                    backup_files_moved += 1
-                    backup_files.append(filename)
+                    moved_files = future.result()
+                    backup_files_moved += len(moved_files)
+                    backup_files.extend(moved_files)
                 except Exception as e:
-                    error_messages.append(f'File {filename} not uploaded over SFTP.')
-                    logging.error(f'File {filename} not uploaded over SFTP. Error: {e}')
-                    files_not_uploaded += 1
-                    failed_files.append(filename)
+                    record_failure(filename, e)
     except Exception as e:
         error_messages.append(f"Error during SFTP file transfer: {e}")
         logging.error(f"SFTP Error: {e}")
+    finally:
+        for ftp_client in sftp_clients:
+            ftp_client.close()
 
     return files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages
 
@@ -418,7 +1097,8 @@ def send_email(smtp_connection, email_sender, email_recipients, email_subject, e
     if skip_file_count != total_file_count:
         if send_when_successful == 'Y' or files_not_uploaded > 0 or exported_file_count < total_file_count or backup_files_moved != exported_file_count:
             try:
-                smtp_connection.sendmail(email_sender, recipient, msg.as_string())
+                with stage('email'):
+                    smtp_connection.sendmail(email_sender, recipient, msg.as_string())
                 logging.info(f"Email sent to: {', '.join(recipient)}")
             except Exception as e:
                 logging.error(f"Error sending email: {e}")
\ No newline at end of file
@@ -0,0 +1,24 @@
+import datetime
+import decimal
+
+
+# Arrow type for a cursor.description type code, shared by the ETL staging files and the
+# interface Parquet exports; None lets Arrow infer it from the values
+def arrow_type_for(pa, type_code, precision, scale):
+    if type_code is bool:
+        return pa.bool_()
+    if type_code is int:
+        return pa.int64()
+    if type_code is float:
+        return pa.float64()
+    if type_code is decimal.Decimal and precision:
+        return pa.decimal128(min(max(precision, 1), 38), scale or 0)
+    if type_code is datetime.datetime:
+        return pa.timestamp('us')
+    if type_code is datetime.date:
+        return pa.date32()
+    if type_code is str:
+        return pa.string()
+    if type_code in (bytes, bytearray):
+        return pa.binary()
+    return None
@@ -0,0 +1,513 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import decimal
+import argparse
+import tempfile
+import threading
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import paramiko
+
+# Benchmark harness for the ETL and interface building blocks, run against local stand-ins
+# instead of production systems:
+#   - SyntheticCursor: a pyodbc-like cursor that generates billing-shaped rows
+#   - PostgreSQL from BENCH_POSTGRES_URL (e.g. postgresql+psycopg2://user:pw@localhost/bench);
+#     the load_to_postgres and create_indexes stages are skipped when it is not set
+#   - an in-process paramiko SFTP server backed by a temporary directory
+#   - a temporary gpg home with a generated key
+#
+#   python benchmark.py --rows 10000,100000 --widths 10,40
+#   python benchmark.py --stages export_data_to_file,transfer_files_sftp --compare benchmark_results/<run>.json
+#
+# Every case runs in a fresh process, so its peak RSS is not inflated by earlier cases.
+# Each run is saved as benchmark_results/<timestamp>_<commit>.json; --compare prints the
+# change in throughput and memory against an earlier run.
+
+STAGES = [
+    'execute_sybase_query',
+    'load_to_postgres',
+    'create_indexes',
+    'export_data_to_file',
+    'encrypt_files_with_gnupg',
+    'transfer_files_sftp',
+]
+
+# Stage variants: (variant name, script_config overrides) for the interface exports
+EXPORT_VARIANTS = [
+    ('csv', {'extension': 'csv'}),
+    ('csv-stream', {'extension': 'csv', 'stream_export': 'Y'}),
+]
+
+# Loader variants: (variant name, etl options) passed through script.extract_query_data and
+# script.load_query_data, so each variant runs the same code path as the ETL flow.
+# staging_dir is relative to the case's scratch directory.
+LOAD_VARIANTS = [
+    ('to_sql', {}),
+    ('copy-text', {'load_method': 'copy', 'copy_format': 'text'}),
+    ('copy-binary', {'load_method': 'copy', 'copy_format': 'binary'}),
+    ('streaming', {'load_method': 'copy', 'fetch_batch_size': 10000}),
+    ('pipelined', {'load_method': 'copy', 'fetch_batch_size': 10000, 'pipeline_queue_size': 4}),
+    ('parquet', {'load_method': 'copy', 'staging_dir': 'staging'}),
+]
+POSTGRES_STAGES = ('load_to_postgres', 'create_indexes')
+
+RESULTS_DIR = 'benchmark_results'
+BENCH_VIEW = 'bench_claims'
+BENCH_TABLE = 'bench_claims'
+
+# Billing-shaped columns: (name, pyodbc type code, precision, scale)
+BILLING_COLUMNS = [
+    ('claim_id', int, 10, 0),
+    ('patient_id', int, 10, 0),
+    ('provider_npi', str, 10, 0),
+    ('cpt_code', str, 5, 0),
+    ('icd10_code', str, 7, 0),
+    ('service_date', datetime, 23, 0),
+    ('billed_amount', decimal.Decimal, 12, 2),
+    ('paid_amount', decimal.Decimal, 12, 2),
+    ('payer_name', str, 40, 0),
+    ('claim_status', str, 10, 0),
+]
+PAYERS = ['MEDICARE', 'MEDICAID', 'BLUE CROSS BLUE SHIELD', 'AETNA', 'UNITED HEALTHCARE', 'SELF PAY']
+STATUSES = ['PAID', 'DENIED', 'PENDING', 'ADJUSTED']
+SERVICE_DATE_START = datetime(2024, 1, 1)
+
+
+# Stand-in for a pyodbc cursor over a billing view. Rows are derived from their index, so
+# every run sees the same data. Widths above the 10 billing columns add 24-character
+# note columns; smaller widths keep the first columns only.
+class SyntheticCursor:
+    def __init__(self, row_count, width=len(BILLING_COLUMNS)):
+        self.row_count = row_count
+        self.width = width
+        self.position = 0
+        self.description = None
+        columns = BILLING_COLUMNS[:width] + [
+            (f'note_{i + 1}', str, 24, 0) for i in range(max(0, width - len(BILLING_COLUMNS)))
+        ]
+        self._columns = columns
+
+    def execute(self, query, params=None):
+        self.position = 0
+        self.description = [
+            (name, type_code, None, precision, precision, scale, True)
+            for name, type_code, precision, scale in self._columns
+        ]
+        return self
+
+    def _row(self, i):
+        billed = decimal.Decimal(5000 + (i * 7919) % 995000) / 100
+        row = (
+            1000000 + i,
+            200000 + (i * 31) % 50000,
+            f"{1000000000 + (i * 17) % 9000000:010d}",
+            f"{99201 + i % 15}",
+            f"E11.{i % 10}{i % 7}",
+            SERVICE_DATE_START + timedelta(days=i % 365, minutes=i % 1440),
+            billed,
+            None if i % 9 == 0 else (billed * decimal.Decimal('0.80')).quantize(decimal.Decimal('0.01')),
+            PAYERS[i % len(PAYERS)],
+            STATUSES[i % len(STATUSES)],
+        )[:self.width]
+        notes = tuple(f"note {i:08d} col {n:02d} abcdef"[:24] for n in range(self.width - len(row)))
+        return row + notes
+
+    def fetchmany(self, size=1):
+        end = min(self.row_count, self.position + size)
+        rows = [self._row(i) for i in range(self.position, end)]
+        self.position = end
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(self.row_count - self.position)
+
+    def nextset(self):
+        return False
+
+    def close(self):
+        pass
+
+
+# ---- Local SFTP server ----
+
+class _SFTPAuthServer(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class _LocalSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+# SFTP server interface serving a local directory as "/"
+class _LocalSFTPServer(paramiko.SFTPServerInterface):
+    root = None
+
+    def _local_path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        local_path = self._local_path(path)
+        entries = []
+        for filename in os.listdir(local_path):
+            attributes = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, filename)))
+            attributes.filename = filename
+            entries.append(attributes)
+        return entries
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._local_path(path), flags | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _LocalSFTPHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._local_path(newpath)):
+            return paramiko.SFTP_FAILURE
+        os.rename(self._local_path(oldpath), self._local_path(newpath))
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self._local_path(oldpath), self._local_path(newpath))
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+# Serve root_dir over SFTP on a free localhost port (any user/password). Returns the port.
+def start_sftp_server(root_dir):
+    _LocalSFTPServer.root = root_dir
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+
+    def accept_loop():
+        while True:
+            connection, _ = listener.accept()
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _LocalSFTPServer)
+            transport.start_server(server=_SFTPAuthServer())
+
+    threading.Thread(target=accept_loop, name='bench-sftp', daemon=True).start()
+    return listener.getsockname()[1]
+
+
+# Create a gpg home with a passphrase-less key and export its public key.
+# Returns the public key path, or None when gpg is not available.
+def create_gpg_key(gpg_home):
+    import gnupg
+
+    try:
+        gpg = gnupg.GPG(gnupghome=gpg_home)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"gpg not available, skipping encryption: {e}")
+        return None
+    key = gpg.gen_key(gpg.gen_key_input(
+        key_type='RSA', key_length=2048, name_real='Benchmark', name_email='benchmark@example.com', no_protection=True
+    ))
+    if not key.fingerprint:
+        print(f"gpg key generation failed, skipping encryption: {key.stderr}")
+        return None
+    public_key_path = os.path.join(gpg_home, 'benchmark_public.asc')
+    with open(public_key_path, 'w') as f:
+        f.write(gpg.export_keys(key.fingerprint))
+    return public_key_path
+
+
+# ---- Cases ----
+
+def interface_script_config(overrides, public_key_path=None):
+    script_config = {
+        'extension': 'csv', 'quote_style': '"', 'separator': '|', 'allow_empty_export': 'N',
+        'encrypt_files': 'N', 'stream_export': 'N', 'export_batch_size': 50000,
+        'pgp_key_file_path': public_key_path,
+    }
+    script_config.update(overrides)
+    return script_config
+
+
+# Run one (stage, variant, rows, width) case in the current process and return its result.
+# Everything the stage needs is prepared first; only the stage call itself is timed.
+def run_case(case, work_dir, postgres_url, public_key_path):
+    os.chdir(work_dir)      # script.py logs to ./data_transfer.log
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from sqlalchemy import create_engine, text
+    import script
+    import Interface_Utility_Export_Transfer_Email_Functions as interface
+
+    stage_name, variant, row_count, width = case['stage'], case['variant'], case['rows'], case['width']
+    item = {'name': BENCH_VIEW, 'type': 'view'}
+    data_folder = os.path.join(work_dir, 'data')
+    backup_folder = os.path.join(work_dir, 'backup')
+    for folder in (data_folder, backup_folder):
+        os.makedirs(folder, exist_ok=True)
+    script_config = interface_script_config(dict(EXPORT_VARIANTS).get(variant, {}), public_key_path)
+    export_path = os.path.join(data_folder, f"{BENCH_VIEW}.{script_config['extension']}")
+
+    def new_cursor():
+        cursor = SyntheticCursor(row_count, width)
+        cursor.execute(f"SELECT * FROM dba.{BENCH_VIEW};")
+        return cursor
+
+    def export_file():
+        interface.export_data_to_file(new_cursor(), export_path, script_config['extension'], script_config)
+
+    engine = None
+    if stage_name in POSTGRES_STAGES:
+        # Start every case from a fresh table, as the column count changes between cases
+        engine = create_engine(postgres_url)
+        with engine.begin() as conn:
+            conn.execute(text(f'DROP TABLE IF EXISTS "{BENCH_TABLE}"'))
+        script.clear_index_cache()
+    if stage_name == 'create_indexes':
+        script.sync_to_postgres(script.execute_sybase_query(SyntheticCursor(row_count, width), item), BENCH_TABLE, engine)
+    elif stage_name == 'load_to_postgres':
+        etl_cfg = dict(LOAD_VARIANTS)[variant]
+    if stage_name == 'encrypt_files_with_gnupg':
+        script_config['encrypt_files'] = 'Y'
+        export_file()
+    elif stage_name == 'transfer_files_sftp':
+        export_file()
+        remote_dir = os.path.join(work_dir, 'remote')
+        os.makedirs(remote_dir, exist_ok=True)
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client.connect('127.0.0.1', port=start_sftp_server(remote_dir), username='bench', password='bench',
+                           allow_agent=False, look_for_keys=False)
+        ftp_client = ssh_client.open_sftp()
+    elif stage_name == 'export_data_to_file':
+        cursor = new_cursor()
+
+    from metrics import current_rss_bytes, peak_rss_bytes
+    baseline_rss = current_rss_bytes()
+    started = time.perf_counter()
+
+    if stage_name == 'execute_sybase_query':
+        result = script.execute_sybase_query(SyntheticCursor(row_count, width), item)
+        size = int(result.memory_usage(index=False, deep=True).sum())
+    elif stage_name == 'load_to_postgres':
+        # Extraction is timed too: the streaming variants overlap it with the load
+        cursor = SyntheticCursor(row_count, width)
+        data = script.extract_query_data(cursor, item, etl_cfg)
+        loaded = script.load_query_data(cursor, data, BENCH_TABLE, engine, item, etl_cfg)
+        if loaded != row_count:
+            raise Exception(f"load_to_postgres loaded {loaded} of {row_count} rows")
+    elif stage_name == 'create_indexes':
+        script.create_indexes(engine, BENCH_TABLE, ['claim_id', 'service_date'], 'bench')
+        size = 0
+    elif stage_name == 'export_data_to_file':
+        interface.export_data_to_file(cursor, export_path, script_config['extension'], script_config)
+        size = os.path.getsize(export_path)
+    elif stage_name == 'encrypt_files_with_gnupg':
+        size = os.path.getsize(export_path)
+        success, _ = interface.encrypt_files_with_gnupg(data_folder, script_config)
+        if not success:
+            raise Exception("encrypt_files_with_gnupg failed")
+    elif stage_name == 'transfer_files_sftp':
+        size = os.path.getsize(export_path)
+        sftp_config = {'remotedirectory': '/', 'resumable_uploads': 'N'}
+        uploaded = interface.transfer_files_sftp(data_folder, ftp_client, {'backup_path': backup_folder}, sftp_config, script_config)[0]
+        if uploaded != 1:
+            raise Exception("transfer_files_sftp did not upload the file")
+
+    seconds = time.perf_counter() - started
+    peak_rss = peak_rss_bytes()
+
+    if stage_name == 'load_to_postgres':
+        with engine.connect() as conn:
+            size = conn.execute(text("SELECT pg_table_size(:name)"), {'name': BENCH_TABLE}).scalar()
+
+    if engine is not None:
+        engine.dispose()
+    return {
+        **case,
+        'backend': engine.dialect.name if engine is not None else None,
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(row_count / seconds, 1) if seconds else None,
+        'bytes': size,
+        'mb_per_second': round(size / seconds / 1024 / 1024, 2) if seconds and size else None,
+        'baseline_rss_mb': round(baseline_rss / 1024 / 1024, 1) if baseline_rss else None,
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1) if peak_rss else None,
+    }
+
+
+# Run a case in its own spawned process with its own scratch directory
+def run_case_isolated(case, scratch_dir, postgres_url, public_key_path):
+    work_dir = tempfile.mkdtemp(prefix=f"{case['stage']}_", dir=scratch_dir)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_case, case, work_dir, postgres_url, public_key_path).result()
+
+
+def build_cases(stages, row_counts, widths):
+    cases = []
+    for stage_name in stages:
+        if stage_name == 'export_data_to_file':
+            variants = [name for name, _ in EXPORT_VARIANTS]
+        elif stage_name == 'load_to_postgres':
+            variants = [name for name, _ in LOAD_VARIANTS]
+        else:
+            variants = ['default']
+        for variant in variants:
+            for row_count in row_counts:
+                for width in widths:
+                    cases.append({'stage': stage_name, 'variant': variant, 'rows': row_count, 'width': width})
+    return cases
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def case_key(result):
+    return (result['stage'], result['variant'], result['rows'], result['width'])
+
+
+def print_results(results, baseline=None):
+    baseline_results = {case_key(result): result for result in (baseline or {}).get('cases', [])}
+    header = f"{'stage':<26} {'variant':<11} {'rows':>9} {'width':>5} {'seconds':>9} {'rows/s':>11} {'MB/s':>8} {'peak MB':>8}"
+    if baseline:
+        header += f" {'rows/s vs base':>15} {'peak vs base':>13}"
+    print(header)
+    for result in results:
+        if 'error' in result:
+            print(f"{result['stage']:<26} {result['variant']:<11} {result['rows']:>9} {result['width']:>5} ERROR: {result['error']}")
+            continue
+        line = (f"{result['stage']:<26} {result['variant']:<11} {result['rows']:>9} {result['width']:>5} "
+                f"{result['seconds']:>9.3f} {result['rows_per_second'] or 0:>11.0f} {result['mb_per_second'] or 0:>8.2f} "
+                f"{result['peak_rss_mb'] or 0:>8.1f}")
+        previous = baseline_results.get(case_key(result))
+        if previous and previous.get('rows_per_second') and result['rows_per_second']:
+            line += f" {result['rows_per_second'] / previous['rows_per_second']:>14.2f}x"
+            if previous.get('peak_rss_mb') and result['peak_rss_mb']:
+                line += f" {result['peak_rss_mb'] - previous['peak_rss_mb']:>+12.1f}M"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ETL and interface stages against local stand-ins.")
+    parser.add_argument('--rows', default='10000,100000', help="comma separated row counts")
+    parser.add_argument('--widths', default='10,40', help="comma separated column counts")
+    parser.add_argument('--stages', default=",".join(STAGES), help="comma separated stages to run")
+    parser.add_argument('--output-dir', default=RESULTS_DIR)
+    parser.add_argument('--compare', help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    stages = [stage_name for stage_name in args.stages.split(',') if stage_name]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}. Known stages: {', '.join(STAGES)}")
+
+    started_at = datetime.now()
+    scratch_dir = tempfile.mkdtemp(prefix='prefect_benchmark_')
+    try:
+        results = run_benchmark(stages, args, scratch_dir)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    run = {
+        'started_at': started_at.isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'postgres': 'postgresql' if os.environ.get('BENCH_POSTGRES_URL') else None,
+        'cases': results,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    result_file = os.path.join(args.output_dir, f"{started_at:%Y%m%d_%H%M%S}_{run['commit']}.json")
+    with open(result_file, 'w') as f:
+        json.dump(run, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print()
+    print_results(results, baseline)
+    print(f"\nResults saved to {result_file}")
+
+
+def run_benchmark(stages, args, scratch_dir):
+    postgres_url = os.environ.get('BENCH_POSTGRES_URL')
+    skipped = [stage_name for stage_name in stages if stage_name in POSTGRES_STAGES]
+    if not postgres_url and skipped:
+        print(f"BENCH_POSTGRES_URL is not set: skipping {', '.join(skipped)}.")
+        stages = [stage_name for stage_name in stages if stage_name not in POSTGRES_STAGES]
+
+    public_key_path = None
+    if 'encrypt_files_with_gnupg' in stages:
+        gpg_home = os.path.join(scratch_dir, 'gnupg')
+        os.makedirs(gpg_home, mode=0o700)
+        public_key_path = create_gpg_key(gpg_home)
+        if public_key_path is None:
+            stages.remove('encrypt_files_with_gnupg')
+        else:
+            os.environ['GNUPGHOME'] = gpg_home     # inherited by the case processes
+
+    row_counts = [int(value) for value in args.rows.split(',')]
+    widths = [int(value) for value in args.widths.split(',')]
+    results = []
+    for case in build_cases(stages, row_counts, widths):
+        try:
+            result = run_case_isolated(case, scratch_dir, postgres_url, public_key_path)
+        except Exception as e:
+            result = {**case, 'error': str(e).splitlines()[0][:200]}
+        results.append(result)
+        print(f"{case['stage']} [{case['variant']}] rows={case['rows']} width={case['width']}: "
+              f"{result.get('seconds', 'error')}s", flush=True)
+    return results
+
+
+if __name__ == "__main__":
+    main()
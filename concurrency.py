@@ -0,0 +1,17 @@
+from prefect.futures import wait
+
+
+# Submit one Prefect task per item with submit(item), keeping at most max_in_flight of them
+# running. A new one is submitted as soon as any running one finishes (checked every
+# poll_interval seconds), so a slow task does not hold up the free slots. Returns the futures
+# in item order; the last ones may still be running.
+def submit_bounded(items, submit, max_in_flight, poll_interval=1):
+    pending = []
+    futures = []
+    for item in items:
+        while len(pending) >= max_in_flight:
+            pending = list(wait(pending, timeout=poll_interval).not_done)
+        future = submit(item)
+        pending.append(future)
+        futures.append(future)
+    return futures
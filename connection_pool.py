@@ -0,0 +1,212 @@
+import time
+import logging
+import threading
+from collections import deque
+
+import pyodbc
+
+logger = logging.getLogger(__name__)
+
+
+# Thin wrapper handed out by the pool. It behaves like the pyodbc connection it wraps, except
+# that close() gives the connection back to the pool instead of closing it.
+class PooledConnection:
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        if self._connection is None:
+            raise pyodbc.ProgrammingError("Attempt to use a connection that was returned to the pool.")
+        return getattr(self._connection, name)
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Thread-safe pool of pyodbc connections for one connection string.
+#   max_size      - most connections open at once (idle + checked out)
+#   idle_timeout  - seconds an idle connection is kept before it is closed
+#   health_check  - run a trivial query on checkout and replace dead connections
+#   wait_timeout  - seconds acquire() waits for a free connection (None waits forever)
+class SybaseConnectionPool:
+    def __init__(self, connection_string, max_size=8, idle_timeout=300, health_check=True,
+                 wait_timeout=None, connect=pyodbc.connect):
+        self.connection_string = connection_string
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.wait_timeout = wait_timeout
+        self._connect = connect
+        self._idle = deque()        # (connection, returned_at), most recently used last
+        self._open_count = 0
+        self._condition = threading.Condition()
+        self._stats = {
+            'creates': 0, 'reuses': 0, 'waits': 0, 'wait_seconds': 0.0,
+            'health_check_failures': 0, 'idle_closed': 0, 'release_failures': 0,
+        }
+
+    def _is_healthy(self, connection):
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except pyodbc.Error:
+            pass
+        with self._condition:
+            self._open_count -= 1
+            self._condition.notify()
+
+    def _take_idle(self):
+        # Called with the lock held. Returns a usable idle connection or None.
+        now = time.monotonic()
+        while self._idle:
+            connection, returned_at = self._idle.pop()
+            if self.idle_timeout is not None and now - returned_at > self.idle_timeout:
+                self._stats['idle_closed'] += 1
+                self._open_count -= 1
+                try:
+                    connection.close()
+                except pyodbc.Error:
+                    pass
+                continue
+            return connection
+        return None
+
+    def acquire(self, timeout=None):
+        timeout = self.wait_timeout if timeout is None else timeout
+        while True:
+            create = False
+            with self._condition:
+                connection = self._take_idle()
+                if connection is None:
+                    if self._open_count < self.max_size:
+                        self._open_count += 1   # reserve the slot, connect outside the lock
+                        create = True
+                    else:
+                        self._stats['waits'] += 1
+                        started = time.monotonic()
+                        if not self._condition.wait_for(lambda: self._idle or self._open_count < self.max_size, timeout):
+                            raise TimeoutError(f"No pooled connection available within {timeout} seconds.")
+                        self._stats['wait_seconds'] += time.monotonic() - started
+                        continue
+
+            if create:
+                try:
+                    connection = self._connect(self.connection_string)
+                except Exception:
+                    with self._condition:
+                        self._open_count -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._stats['creates'] += 1
+                return PooledConnection(self, connection)
+
+            if self.health_check and not self._is_healthy(connection):
+                with self._condition:
+                    self._stats['health_check_failures'] += 1
+                self._discard(connection)
+                continue
+
+            with self._condition:
+                self._stats['reuses'] += 1
+            return PooledConnection(self, connection)
+
+    def release(self, connection):
+        # Roll back whatever the borrower left open, as closing the connection would have done
+        try:
+            connection.rollback()
+        except pyodbc.Error:
+            with self._condition:
+                self._stats['release_failures'] += 1
+            self._discard(connection)
+            return
+
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    # Open connections up front so the first tasks of a run do not pay the connect cost
+    def warmup(self, count):
+        connections = []
+        try:
+            for _ in range(min(count, self.max_size)):
+                connections.append(self.acquire())
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats['open'] = self._open_count
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._open_count - len(self._idle)
+        return stats
+
+    def close_all(self):
+        with self._condition:
+            idle, self._idle = list(self._idle), deque()
+            self._open_count -= len(idle)
+        for connection, _ in idle:
+            try:
+                connection.close()
+            except pyodbc.Error:
+                pass
+
+
+# One pool per connection string (i.e. per DSN parameters) in this process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# Return the shared pool for a connection string, creating it with the given options
+# (max_size, idle_timeout, health_check, wait_timeout, warmup) on first use
+def get_pool(connection_string, **options):
+    warmup = options.pop('warmup', 0)
+    with _pools_lock:
+        pool = _pools.get(connection_string)
+        if pool is None:
+            pool = SybaseConnectionPool(connection_string, **options)
+            _pools[connection_string] = pool
+            created = True
+        else:
+            created = False
+    if created and warmup:
+        pool.warmup(int(warmup))
+    return pool
+
+
+# Statistics of every pool, keyed by the server/database part of the connection string
+def all_pool_stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {
+        ";".join(part for part in pool.connection_string.split(";") if part.startswith(("Server=", "Database="))): pool.stats()
+        for pool in pools
+    }
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
@@ -3,8 +3,14 @@ from prefect import flow, task, get_run_logger
 from cryptography.fernet import Fernet
 import pyodbc
 import smtplib
+import os
+import glob
 from datetime import datetime
 
+from connection_pool import get_pool, all_pool_stats
+from concurrency import submit_bounded
+from metrics import reset_metrics, publish_metrics
+from profiling import profiled, resolve_profile_mode, start_profiling, stop_profiling
 from Interface_Utility_Export_Transfer_Email_Functions import (
     load_config,
     decrypt_password,
@@ -12,11 +18,13 @@ from Interface_Utility_Export_Transfer_Email_Functions import (
     encrypt_files_with_gnupg,
     connect_to_sftp,
     transfer_files_sftp,
+    transfer_files_sftp_parallel,
     send_email,
 )
 
 
 @task
+@profiled
 def task_load_config(config_path: str):
     logger = get_run_logger()
     logger.info("Loading configuration...")
@@ -26,45 +34,72 @@ def task_load_config(config_path: str):
     return server_config, script_config, sftp_config, email_config
 
 
+# ODBC connection string for the IMS database of an interface
+def build_connection_string(server_config, cipher):
+    decrypted_db_password = decrypt_password(server_config['ims_db_password'], cipher)
+    return (
+        f'Driver={server_config["Driver_name"]};'
+        f'Server={server_config["ims_service_name"]};'
+        f'Database={server_config["ims_db_name"]};'
+        f'UID={server_config["ims_db_user_name"]};'
+        f'PWD={decrypted_db_password};'
+    )
+
+
+# Open an IMS connection, drawn from the shared pool when server_config has a
+# connection_pool section (max_size, idle_timeout, health_check, wait_timeout, warmup)
+def connect_ims(server_config, cipher):
+    connection_string = build_connection_string(server_config, cipher)
+    pool_config = server_config.get('connection_pool')
+    if pool_config:
+        return get_pool(connection_string, **pool_config).acquire()
+    return pyodbc.connect(connection_string)
+
+
 @task
-def task_db_and_export(server_config, script_config, from_date_str, to_date_str, data_folder, backup_folder, cipher):
+@profiled
+def task_db_and_export(server_config, script_config, from_date_str, to_date_str, data_folder, backup_folder, cipher, conn=None):
     logger = get_run_logger()
     logger.info("Connecting to database and exporting data...")
 
-    decrypted_db_password = decrypt_password(server_config['ims_db_password'], cipher)
     exported_file_count, exported_files, skip_file_count, error_messages, file_export_successful = 0, [], 0, [], False
+    # A connection passed in (batch runs) is shared with other interfaces and stays open
+    owns_connection = conn is None
+    cursor = None
 
     try:
-        conn = pyodbc.connect(
-            f'Driver={server_config["Driver_name"]};'
-            f'Server={server_config["ims_service_name"]};'
-            f'Database={server_config["ims_db_name"]};'
-            f'UID={server_config["ims_db_user_name"]};'
-            f'PWD={decrypted_db_password};'
-        )
-        logger.info("Database connection established successfully.")
+        if owns_connection:
+            conn = connect_ims(server_config, cipher)
+            logger.info("Database connection established successfully.")
         cursor = conn.cursor()
 
+        # Extra connections for parallel exports (script_config max_parallel_exports)
         error_messages, file_export_successful, exported_file_count, exported_files, skip_file_count = execute_queries(
-            cursor, script_config, from_date_str, to_date_str, data_folder, backup_folder
+            cursor, script_config, from_date_str, to_date_str, data_folder, backup_folder,
+            connection_factory=lambda: connect_ims(server_config, cipher)
         )
 
         logger.error(f"Error Message in task_db_and_export: {error_messages}")
         logger.info(f"File Export count: {exported_file_count}")
         logger.info(f"Exported Files: {exported_files}")
         logger.info(f"Skip file count: {skip_file_count}")
-        cursor.close()
-        conn.close()
-        logger.info("Database connection closed.")
 
     except Exception as e:
         logger.error(f"Database Error: {e}")
         error_messages.append("Database connection failed.")
+    finally:
+        # Also after a failed export, so a pooled connection goes back to its pool
+        if cursor is not None:
+            cursor.close()
+        if owns_connection and conn is not None:
+            conn.close()
+            logger.info("Database connection closed.")
 
     return error_messages, file_export_successful, exported_file_count, exported_files, skip_file_count
 
 
 @task
+@profiled
 def task_encrypt_files(script_config, data_folder):
     logger = get_run_logger()
     logger.info("Checking if encryption is required...")
@@ -79,26 +114,37 @@ def task_encrypt_files(script_config, data_folder):
 
 
 @task
-def task_sftp_transfer(server_config, sftp_config, script_config, data_folder, cipher, db_connection_successful, file_export_successful):
+@profiled
+def task_sftp_transfer(server_config, sftp_config, script_config, data_folder, cipher, db_connection_successful, file_export_successful, ssh_client=None):
     logger = get_run_logger()
     files_uploaded = files_not_uploaded = backup_files_moved = 0
     uploaded_files = failed_files = backup_files = []
     error_messages = []
+    # An SSH client passed in (batch runs) is shared with other interfaces and stays open
+    owns_ssh_client = ssh_client is None
 
     try:
         if db_connection_successful and file_export_successful and server_config.get('file_transfer_using_SFTP', '').upper() == "Y":
-            decrypted_sftp_password = decrypt_password(sftp_config['sftp_password'], cipher)
-            ssh_client = connect_to_sftp(
-                sftp_config['hostname'], sftp_config['username'],
-                decrypted_sftp_password, sftp_config['PPK_file_path'], int(sftp_config['port'])
-            )
-            if ssh_client:
-                ftp_client = ssh_client.open_sftp()
-                files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages = transfer_files_sftp(
-                    data_folder, ftp_client, server_config, sftp_config, script_config
+            if owns_ssh_client:
+                decrypted_sftp_password = decrypt_password(sftp_config['sftp_password'], cipher)
+                ssh_client = connect_to_sftp(
+                    sftp_config['hostname'], sftp_config['username'],
+                    decrypted_sftp_password, sftp_config['PPK_file_path'], int(sftp_config['port'])
                 )
-                ftp_client.close()
-                ssh_client.close()
+            if ssh_client:
+                max_parallel_uploads = int(sftp_config.get('max_parallel_uploads', 1))
+                if max_parallel_uploads > 1:
+                    files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages = transfer_files_sftp_parallel(
+                        data_folder, ssh_client, server_config, sftp_config, script_config, max_parallel_uploads
+                    )
+                else:
+                    ftp_client = ssh_client.open_sftp()
+                    files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages = transfer_files_sftp(
+                        data_folder, ftp_client, server_config, sftp_config, script_config
+                    )
+                    ftp_client.close()
+                if owns_ssh_client:
+                    ssh_client.close()
     except Exception as e:
         logger.error(f"SFTP Error: {e}")
         error_messages.append(f"Failed to transfer files over SFTP: {e}")
@@ -106,19 +152,28 @@ def task_sftp_transfer(server_config, sftp_config, script_config, data_folder, c
     return files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages
 
 
+def open_smtp_connection(email_config, cipher):
+    decrypted_email_password = decrypt_password(email_config['smtp_encrypted_password'], cipher)
+    smtp_connection = smtplib.SMTP(email_config['email_smtp'], email_config['email_port'])
+    smtp_connection.starttls()
+    smtp_connection.login(email_config['email_sender'], decrypted_email_password)
+    return smtp_connection
+
+
 @task
+@profiled
 def task_send_email(email_config, cipher, exported_file_count, exported_files,
                     files_uploaded, files_not_uploaded, uploaded_files, failed_files,
-                    error_messages, backup_files_moved, backup_files, skip_file_count):
+                    error_messages, backup_files_moved, backup_files, skip_file_count, smtp_connection=None):
     logger = get_run_logger()
     logger.info("Preparing to send email...")
 
-    decrypted_email_password = decrypt_password(email_config['smtp_encrypted_password'], cipher)
+    # An SMTP session passed in (batch runs) is shared with other interfaces and stays open
+    owns_smtp_connection = smtp_connection is None
 
     try:
-        smtp_connection = smtplib.SMTP(email_config['email_smtp'], email_config['email_port'])
-        smtp_connection.starttls()
-        smtp_connection.login(email_config['email_sender'], decrypted_email_password)
+        if owns_smtp_connection:
+            smtp_connection = open_smtp_connection(email_config, cipher)
 
         total_file_count = int(email_config['total_file_count'])
         formatted_date = datetime.now().strftime('%d %b %Y')
@@ -142,60 +197,301 @@ def task_send_email(email_config, cipher, exported_file_count, exported_files,
             backup_files,
             skip_file_count
         )
-        smtp_connection.quit()
+        if owns_smtp_connection:
+            smtp_connection.quit()
         logger.info("Email sent successfully.")
     except Exception as e:
         logger.error(f"Error sending email: {e}")
 
 
+# profile: 'cprofile' or 'pyinstrument' runs every task under that profiler (default: the
+# PREFECT_FLOW_PROFILE environment variable); output goes next to the interface log
 @flow(name="custom_interface_etl_flow")
-def custom_interface_etl_flow(config_path: str):
+def custom_interface_etl_flow(config_path: str, profile: str = ""):
 
     logger = get_run_logger()
 
     logger.info(f"ETL flow started using config: {config_path}")
+    reset_metrics()
+    interface_name = os.path.splitext(os.path.basename(config_path))[0]
+    start_profiling(f"custom_interface_{interface_name}", resolve_profile_mode(profile), os.path.dirname(config_path))
+    metrics_dir = os.path.dirname(config_path)
+    try:
+        # Encryption setup
+        # Load encryption key from Prefect block
+        secret_block = Secret.load("custom-interface-password-encryption-key")
+        encryption_key = secret_block.get()
+        cipher = Fernet(encryption_key)
 
-    # Encryption setup
-    # Load encryption key from Prefect block
-    secret_block = Secret.load("custom-interface-password-encryption-key")
-    encryption_key = secret_block.get()
-    cipher = Fernet(encryption_key)
+
+        # Task 1: Load config
+        server_config, script_config, sftp_config, email_config = task_load_config(config_path)
+        metrics_dir = script_config.get('metrics_dir', metrics_dir)
+
+        data_folder = server_config['folder_path']
+        backup_folder = server_config['backup_path']
+        from_date_str = script_config.get('from_date', 'today')
+        to_date_str = script_config.get('to_date', 'today')
+
+        # Task 2: DB + Export
+        error_messages, file_export_successful, exported_file_count, exported_files, skip_file_count = task_db_and_export(
+            server_config, script_config, from_date_str, to_date_str, data_folder, backup_folder, cipher
+        )
+
+        # Task 3: Encrypt files if needed
+        encrypted_files = task_encrypt_files(script_config, data_folder)
+
+        # Task 4: SFTP transfer
+        files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages_sftp = task_sftp_transfer(
+            server_config, sftp_config, script_config, data_folder, cipher, True, file_export_successful
+        )
+        error_messages.extend(error_messages_sftp)
+
+        # Task 5: Send Email
+        task_send_email(
+            email_config, cipher,
+            exported_file_count, exported_files,
+            files_uploaded, files_not_uploaded,
+            uploaded_files, failed_files,
+            error_messages,
+            backup_files_moved, backup_files,
+            skip_file_count
+        )
+
+        pool_stats = all_pool_stats()
+        if pool_stats:
+            logger.info(f"IMS connection pool stats: {pool_stats}")
+
+        logger.info("ETL flow completed successfully")
+    finally:
+        # Per-stage timings, written next to the interface log (script_config metrics_dir
+        # overrides), also when the flow failed
+        publish_metrics(f"custom_interface_{interface_name}", metrics_dir)
+        stop_profiling()
+
+# ---- Batch runs over many interface configs ----
+
+# Resolve a directory (searched recursively for *.json) or a glob pattern to config paths
+def resolve_config_paths(config_location):
+    if os.path.isdir(config_location):
+        pattern = os.path.join(config_location, "**", "*.json")
+    else:
+        pattern = config_location
+    return sorted(glob.glob(pattern, recursive=True))
 
 
-    # Task 1: Load config
-    server_config, script_config, sftp_config, email_config = task_load_config(config_path)
+# Group interface configs that talk to the same IMS database, SFTP server and SMTP server,
+# so one group can share a single connection to each of them. A config that cannot be read
+# or lacks a connection setting is returned in failed_configs and the rest still run.
+def group_interface_configs(config_paths):
+    logger = get_run_logger()
+    groups = {}
+    failed_configs = []
+    for config_path in config_paths:
+        try:
+            server_config, script_config, sftp_config, email_config = load_config(config_path)
+            db_key = (server_config['Driver_name'], server_config['ims_service_name'],
+                      server_config['ims_db_name'], server_config['ims_db_user_name'])
+            if server_config.get('file_transfer_using_SFTP', '').upper() == "Y":
+                sftp_key = (sftp_config['hostname'], int(sftp_config['port']), sftp_config['username'])
+            else:
+                sftp_key = None
+            smtp_key = (email_config['email_smtp'], email_config['email_port'], email_config['email_sender'])
+        except Exception as e:
+            logger.error(f"Interface {config_path} failed: could not read config: {e!r}")
+            failed_configs.append(config_path)
+            continue
+        groups.setdefault((db_key, sftp_key, smtp_key), []).append(config_path)
+    return groups, failed_configs
+
+
+# Connections shared by the interfaces of one group. Each one is opened on first use and
+# re-opened if it has gone stale; None means the connection could not be made, in which
+# case every interface falls back to opening its own and reports the error as usual.
+class InterfaceGroupConnections:
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self.db_conn = None
+        self.ssh_client = None
+        self.smtp_connection = None
+
+    def get_db_connection(self, server_config):
+        if self.db_conn is not None:
+            try:
+                cursor = self.db_conn.cursor()
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+                cursor.close()
+            except Exception as e:
+                get_run_logger().warning(f"Shared database connection is stale, reconnecting: {e}")
+                self.discard_db_connection()
+        if self.db_conn is None:
+            try:
+                self.db_conn = connect_ims(server_config, self.cipher)
+            except Exception as e:
+                get_run_logger().error(f"Shared database connection failed: {e}")
+        return self.db_conn
+
+    # Roll back after every interface, as closing its own connection does in a standalone
+    # run, so no transaction carries over to the next one
+    def end_db_transaction(self):
+        if self.db_conn is None:
+            return
+        try:
+            self.db_conn.rollback()
+        except Exception as e:
+            get_run_logger().error(f"Error ending shared database transaction: {e}")
+            self.discard_db_connection()
+
+    def discard_db_connection(self):
+        try:
+            self.db_conn.close()
+        except Exception:
+            pass
+        self.db_conn = None
+
+    def get_ssh_client(self, sftp_config):
+        if self.ssh_client is not None and not (self.ssh_client.get_transport() and self.ssh_client.get_transport().is_active()):
+            self.ssh_client = None
+        if self.ssh_client is None:
+            decrypted_sftp_password = decrypt_password(sftp_config['sftp_password'], self.cipher)
+            self.ssh_client = connect_to_sftp(
+                sftp_config['hostname'], sftp_config['username'],
+                decrypted_sftp_password, sftp_config['PPK_file_path'], int(sftp_config['port'])
+            )
+        return self.ssh_client
+
+    def get_smtp_connection(self, email_config):
+        if self.smtp_connection is not None:
+            try:
+                self.smtp_connection.noop()
+            except Exception:
+                self.smtp_connection = None
+        if self.smtp_connection is None:
+            try:
+                self.smtp_connection = open_smtp_connection(email_config, self.cipher)
+            except Exception as e:
+                get_run_logger().error(f"Shared SMTP connection failed: {e}")
+        return self.smtp_connection
+
+    def close(self):
+        for close in (
+            lambda: self.db_conn and self.db_conn.close(),
+            lambda: self.ssh_client and self.ssh_client.close(),
+            lambda: self.smtp_connection and self.smtp_connection.quit(),
+        ):
+            try:
+                close()
+            except Exception as e:
+                get_run_logger().error(f"Error closing shared connection: {e}")
+
+
+# Same steps as custom_interface_etl_flow for one interface, using the group's connections
+def run_interface(config_path, cipher, connections):
+    logger = get_run_logger()
+    logger.info(f"Interface started using config: {config_path}")
+
+    server_config, script_config, sftp_config, email_config = task_load_config.fn(config_path)
 
     data_folder = server_config['folder_path']
     backup_folder = server_config['backup_path']
     from_date_str = script_config.get('from_date', 'today')
     to_date_str = script_config.get('to_date', 'today')
 
-    # Task 2: DB + Export
-    error_messages, file_export_successful, exported_file_count, exported_files, skip_file_count = task_db_and_export(
-        server_config, script_config, from_date_str, to_date_str, data_folder, backup_folder, cipher
+    error_messages, file_export_successful, exported_file_count, exported_files, skip_file_count = task_db_and_export.fn(
+        server_config, script_config, from_date_str, to_date_str, data_folder, backup_folder, cipher,
+        conn=connections.get_db_connection(server_config)
     )
 
-    # Task 3: Encrypt files if needed
-    encrypted_files = task_encrypt_files(script_config, data_folder)
+    task_encrypt_files.fn(script_config, data_folder)
 
-    # Task 4: SFTP transfer
-    files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages_sftp = task_sftp_transfer(
-        server_config, sftp_config, script_config, data_folder, cipher, True, file_export_successful
+    ssh_client = None
+    if file_export_successful and server_config.get('file_transfer_using_SFTP', '').upper() == "Y":
+        ssh_client = connections.get_ssh_client(sftp_config)
+    files_uploaded, files_not_uploaded, backup_files_moved, uploaded_files, failed_files, backup_files, error_messages_sftp = task_sftp_transfer.fn(
+        server_config, sftp_config, script_config, data_folder, cipher, True, file_export_successful,
+        ssh_client=ssh_client
     )
     error_messages.extend(error_messages_sftp)
 
-    # Task 5: Send Email
-    task_send_email(
+    task_send_email.fn(
         email_config, cipher,
         exported_file_count, exported_files,
         files_uploaded, files_not_uploaded,
         uploaded_files, failed_files,
         error_messages,
         backup_files_moved, backup_files,
-        skip_file_count
+        skip_file_count,
+        smtp_connection=connections.get_smtp_connection(email_config)
     )
 
-    logger.info("ETL flow completed successfully")
+    logger.info(f"Interface completed: {config_path}")
+
+
+@task
+def task_run_interface_group(config_paths, cipher):
+    logger = get_run_logger()
+    connections = InterfaceGroupConnections(cipher)
+    failed_configs = []
+    try:
+        for config_path in config_paths:
+            try:
+                run_interface(config_path, cipher, connections)
+            except Exception as e:
+                logger.error(f"Interface {config_path} failed: {e}")
+                failed_configs.append(config_path)
+            finally:
+                connections.end_db_transaction()
+    finally:
+        connections.close()
+    return failed_configs
+
+
+@flow(name="custom_interface_batch_flow")
+def custom_interface_batch_flow(config_location: str, max_parallel_groups: int = 4, poll_interval: float = 1):
+    logger = get_run_logger()
+
+    config_paths = resolve_config_paths(config_location)
+    logger.info(f"Batch flow started for {len(config_paths)} interface configs from: {config_location}")
+    reset_metrics()
+
+    # Encryption setup, loaded once for every interface of the batch
+    secret_block = Secret.load("custom-interface-password-encryption-key")
+    encryption_key = secret_block.get()
+    cipher = Fernet(encryption_key)
+
+    metrics_dir = config_location if os.path.isdir(config_location) else os.path.dirname(config_location)
+    try:
+        groups, failed_configs = group_interface_configs(config_paths)
+        logger.info(f"{len(groups)} connection groups to run")
+
+        # Run the groups side by side, keeping at most max_parallel_groups in flight
+        futures = submit_bounded(
+            enumerate(groups.values(), start=1),
+            lambda group: task_run_interface_group.with_options(name=f"interface group {group[0]}").submit(group[1], cipher),
+            max_parallel_groups, poll_interval
+        )
+
+        # A group task that crashed counts every interface of the group as failed
+        for future, group_configs in zip(futures, groups.values()):
+            try:
+                failed_configs += future.result()
+            except Exception as e:
+                logger.error(f"Interface group {group_configs} crashed: {e}")
+                failed_configs += group_configs
+
+        if failed_configs:
+            raise Exception(f"{len(failed_configs)} interfaces failed: {failed_configs}")
+    finally:
+        # Per-stage timings of all interfaces of the batch, written next to the configs,
+        # also when interfaces failed
+        publish_metrics("custom_interface_batch_flow", metrics_dir)
+
+        pool_stats = all_pool_stats()
+        if pool_stats:
+            logger.info(f"IMS connection pool stats: {pool_stats}")
+
+    logger.info("Batch flow completed successfully")
 
 #
 # if __name__ == "__main__":
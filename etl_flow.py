@@ -1,19 +1,25 @@
 from prefect import flow, task, get_run_logger
+from prefect.futures import wait
 from prefect_email import EmailServerCredentials, email_send_message
 from prefect import get_run_logger
 from script import (
     load_config,
     get_sybase_connection,
     get_postgres_engine,
-    execute_sybase_query,
-    sync_to_postgres,
-    create_indexes,
-    execute_postgres_procedures
+    extract_and_sync_query,
+    rebuild_deferred_indexes,
+    clear_index_cache,
+    ProcedureRunner
 )
+from connection_pool import all_pool_stats
+from concurrency import submit_bounded
+from metrics import stage, reset_metrics, publish_metrics
+from profiling import profiled, resolve_profile_mode, start_profiling, stop_profiling
 import datetime
 
 
 @task
+@profiled
 def send_email_notification(subject: str, message: str, email_cfg: dict):
     logger = get_run_logger()
     try:
@@ -22,19 +28,21 @@ def send_email_notification(subject: str, message: str, email_cfg: dict):
 
         for recipient in recipients:
             logger.info(f"Sending email to {recipient}...")
-            result = email_send_message.with_options(name=f"notify {recipient}").submit(
-                email_server_credentials=creds,
-                subject=subject,
-                msg=message,
-                email_to=recipient
-            )
-            result.result()  # Wait synchronously
+            with stage('email'):
+                result = email_send_message.with_options(name=f"notify {recipient}").submit(
+                    email_server_credentials=creds,
+                    subject=subject,
+                    msg=message,
+                    email_to=recipient
+                )
+                result.result()  # Wait synchronously
         logger.info("All emails sent successfully.")
     except Exception as e:
         logger.error(f"Failed to send email: {e}")
 
 @task
-def extract_and_load():
+@profiled
+def extract_and_load(procedures=None):
     logger = get_run_logger()
     config = load_config()
     sybase_conn = get_sybase_connection(config['sybase'])
@@ -43,15 +51,13 @@ def extract_and_load():
 
     for item in config['queries']:
         try:
-            df = execute_sybase_query(cursor, item)
-            if not df.empty:
-                table = item.get("target_table", item['name'])
-                sync_to_postgres(df, table, postgres_engine)
-                create_indexes(postgres_engine, table, item.get('index_columns', []), item.get('index_prefix', 'idx'))
-            else:
+            row_count = extract_and_sync_query(cursor, item, postgres_engine, config.get('etl', {}), config['sybase'])
+            if not row_count:
                 logger.warning(f"No data from {item['name']}")
         except Exception as e:
             logger.error(f"Error in {item['name']}: {e}")
+        if procedures is not None:
+            procedures.query_loaded(item)
 
     cursor.close()
     sybase_conn.close()
@@ -59,23 +65,92 @@ def extract_and_load():
 
 
 @task
-def run_postgres_procedures(postgres_engine, config):
-    success = execute_postgres_procedures(postgres_engine, config.get("postgres_procedures", []))
+@profiled
+def extract_and_load_query(item, config, procedures=None):
+    logger = get_run_logger()
+    sybase_conn = cursor = None
+    try:
+        # Every query gets its own Sybase connection and its own connection from the shared,
+        # cached Postgres engine, so they can run side by side
+        sybase_conn = get_sybase_connection(config['sybase'])
+        postgres_engine = get_postgres_engine(config['postgres'])
+        cursor = sybase_conn.cursor()
+
+        row_count = extract_and_sync_query(cursor, item, postgres_engine, config.get('etl', {}), config['sybase'])
+        if not row_count:
+            logger.warning(f"No data from {item['name']}")
+        return True
+    except Exception as e:
+        logger.error(f"Error in {item['name']}: {e}")
+        return False
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if sybase_conn is not None:
+            sybase_conn.close()
+        if procedures is not None:
+            procedures.query_loaded(item)
+
+
+# Run every configured query as its own task, keeping at most max_parallel of them in flight
+def extract_and_load_parallel(config, max_parallel, procedures=None, poll_interval=1):
+    futures = submit_bounded(
+        config['queries'],
+        lambda item: extract_and_load_query.with_options(name=f"extract {item['name']}").submit(item, config, procedures),
+        max_parallel, poll_interval
+    )
+    wait(futures)
+
+
+@task
+@profiled
+def rebuild_indexes(postgres_engine, config):
+    logger = get_run_logger()
+    if not rebuild_deferred_indexes(postgres_engine, config['queries'], config.get('etl', {})):
+        logger.error("One or more deferred index builds failed.")
+
+
+# Wait for the procedures that are still running or waiting on the deferred index builds
+@task
+@profiled
+def run_postgres_procedures(procedures):
+    success = procedures.wait()
     if not success:
         raise Exception("One or more PostgreSQL procedures failed.")
     return "Data sync complete."
 
 
 
+# profile: 'cprofile' or 'pyinstrument' runs every task under that profiler (default: the
+# PREFECT_FLOW_PROFILE environment variable); output goes next to data_transfer.log
 @flow(name="Sybase-to-Postgres ETL Flow", log_prints=True)
-def main_etl_flow():
+def main_etl_flow(profile: str = ""):
     config = load_config()
     email_cfg = config.get("email", {})
     subject = email_cfg.get("subject", "ETL Status")
 
+    reset_metrics()
+    start_profiling("main_etl_flow", resolve_profile_mode(profile))
     try:
-        postgres_engine, config = extract_and_load()
-        run_postgres_procedures(postgres_engine, config)
+        clear_index_cache()
+        etl_cfg = config.get('etl', {})
+        # postgres_procedures start while the queries are loaded, as soon as their inputs are ready
+        procedures = ProcedureRunner(
+            get_postgres_engine(config['postgres']), config.get("postgres_procedures", []), config['queries'],
+            etl_cfg.get('procedure_workers', 1), etl_cfg
+        )
+        max_parallel = int(etl_cfg.get('max_parallel_queries', 1))
+        if max_parallel > 1:
+            extract_and_load_parallel(config, max_parallel, procedures)
+            postgres_engine = get_postgres_engine(config['postgres'])
+        else:
+            postgres_engine, config = extract_and_load(procedures)
+        rebuild_indexes(postgres_engine, config)
+        run_postgres_procedures(procedures)
+
+        pool_stats = all_pool_stats()
+        if pool_stats:
+            get_run_logger().info(f"Sybase connection pool stats: {pool_stats}")
 
         # Success Email
         send_email_notification(
@@ -91,6 +166,10 @@ def main_etl_flow():
             email_cfg=email_cfg
         )
         raise
+    finally:
+        # Per-stage timings of this run: <metrics_dir>/main_etl_flow_metrics.prom/.jsonl + artifact
+        publish_metrics("main_etl_flow", config.get('etl', {}).get('metrics_dir', '.'))
+        stop_profiling()
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,272 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager, ExitStack
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Per-stage run metrics shared by the ETL and the interface flows.
+#
+#   with stage('postgres_load', query=name) as m:
+#       m['rows'] = load(...)
+#
+# Every stage reports wall time, rows, bytes and the peak RSS seen while it was open (the
+# RSS on entry and exit, and a background sample every RSS_SAMPLE_INTERVAL seconds; RSS is
+# per process, so stages running at the same time see each other's memory). Stages may
+# nest; 'self_seconds' is the wall time minus the time spent in nested stages of the same
+# thread, so the stages of one run add up without double counting.
+# Stages are aggregated by name and labels, so a stage entered once per fetch batch
+# still shows up as a single line.
+
+_lock = threading.Lock()
+_stages = {}        # (stage, labels) -> aggregated values
+_local = threading.local()
+# Context manager factories entered around every stage as hook(name, labels), e.g. the
+# allocation snapshots of the profiling mode
+_stage_hooks = []
+
+
+RSS_SAMPLE_INTERVAL = 0.05
+# Stages currently open in any thread, updated by the RSS sampler thread while there are any
+_open_stages = {}     # id -> stage dict
+_rss_lock = threading.Lock()
+_rss_sampler = None
+
+
+# Process peak RSS since start-up (not per stage; the stages use current_rss_bytes samples)
+def peak_rss_bytes():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024     # kilobytes on Linux
+    except ImportError:     # Windows
+        try:
+            import psutil
+            memory = psutil.Process().memory_info()
+            return getattr(memory, 'peak_wset', memory.rss)
+        except ImportError:
+            return None
+
+
+# Reader of the current RSS, picked once at import: /proc/self/statm on Linux, psutil
+# elsewhere when it is installed, otherwise no RSS at all
+def _rss_reader():
+    if os.path.exists('/proc/self/statm'):
+        page_size = os.sysconf('SC_PAGE_SIZE')
+
+        def read_statm():
+            try:
+                with open('/proc/self/statm') as f:
+                    return int(f.read().split()[1]) * page_size
+            except (OSError, ValueError):
+                return None
+        return read_statm
+    try:
+        import psutil
+    except ImportError:
+        return lambda: None
+    return lambda: psutil.Process().memory_info().rss
+
+
+current_rss_bytes = _rss_reader()
+
+
+def _sample_rss():
+    global _rss_sampler
+    while True:
+        time.sleep(RSS_SAMPLE_INTERVAL)
+        rss = current_rss_bytes()
+        with _rss_lock:
+            if not _open_stages or rss is None:
+                _rss_sampler = None
+                return
+            for current in _open_stages.values():
+                current['peak_rss'] = max(current['peak_rss'] or 0, rss)
+
+
+def _open_stage(current):
+    global _rss_sampler
+    current['peak_rss'] = current_rss_bytes()
+    with _rss_lock:
+        _open_stages[id(current)] = current
+        if _rss_sampler is None and current['peak_rss'] is not None:
+            _rss_sampler = threading.Thread(target=_sample_rss, name="stage-rss-sampler", daemon=True)
+            _rss_sampler.start()
+
+
+def _close_stage(current):
+    rss = current_rss_bytes()
+    with _rss_lock:
+        del _open_stages[id(current)]
+        if rss is not None:
+            current['peak_rss'] = max(current['peak_rss'] or 0, rss)
+    return current['peak_rss']
+
+
+def add_stage_hook(hook):
+    _stage_hooks.append(hook)
+
+
+def remove_stage_hook(hook):
+    if hook in _stage_hooks:
+        _stage_hooks.remove(hook)
+
+
+def reset_metrics():
+    with _lock:
+        _stages.clear()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _record(name, labels, seconds, self_seconds, rows, size, failed, peak_rss):
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _lock:
+        values = _stages.get(key)
+        if values is None:
+            values = _stages[key] = {
+                'calls': 0, 'errors': 0, 'seconds': 0.0, 'self_seconds': 0.0,
+                'rows': 0, 'bytes': 0, 'peak_rss_bytes': 0,
+            }
+        values['calls'] += 1
+        values['errors'] += 1 if failed else 0
+        values['seconds'] += seconds
+        values['self_seconds'] += self_seconds
+        values['rows'] += rows or 0
+        values['bytes'] += size or 0
+        if peak_rss:
+            values['peak_rss_bytes'] = max(values['peak_rss_bytes'], peak_rss)
+
+
+# Time a stage. The yielded dict takes the stage's 'rows' and 'bytes'; add_to_stage()
+# adds to the innermost open stage from code that does not hold the dict.
+@contextmanager
+def stage(name, **labels):
+    current = {'rows': 0, 'bytes': 0, 'child_seconds': 0.0}
+    stack = _stack()
+    stack.append(current)
+    _open_stage(current)
+    started = time.perf_counter()
+    failed = False
+    try:
+        if _stage_hooks:
+            with ExitStack() as hooks:
+                for hook in list(_stage_hooks):
+                    hooks.enter_context(hook(name, labels))
+                yield current
+        else:
+            yield current
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        peak_rss = _close_stage(current)
+        stack.pop()
+        if stack:
+            stack[-1]['child_seconds'] += seconds
+        _record(name, labels, seconds, seconds - current['child_seconds'], current['rows'], current['bytes'], failed, peak_rss)
+
+
+def add_to_stage(rows=0, bytes=0):
+    stack = _stack()
+    if stack:
+        stack[-1]['rows'] += rows
+        stack[-1]['bytes'] += bytes
+
+
+# Aggregated stage metrics, slowest first, with throughput per second of stage wall time
+def metrics_summary():
+    with _lock:
+        items = [(key, dict(values)) for key, values in _stages.items()]
+
+    summary = []
+    for (name, labels), values in items:
+        entry = {'stage': name, **dict(labels), **values}
+        seconds = values['seconds']
+        entry['rows_per_second'] = round(values['rows'] / seconds, 1) if seconds and values['rows'] else 0
+        entry['bytes_per_second'] = round(values['bytes'] / seconds, 1) if seconds and values['bytes'] else 0
+        entry['seconds'] = round(seconds, 3)
+        entry['self_seconds'] = round(values['self_seconds'], 3)
+        summary.append(entry)
+    summary.sort(key=lambda entry: entry['seconds'], reverse=True)
+    return summary
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Prometheus textfile-collector format (node_exporter --collector.textfile)
+def format_prometheus(flow_name, summary):
+    lines = []
+    metrics = [
+        ('calls', 'counter', 'Number of times the stage ran'),
+        ('errors', 'counter', 'Number of times the stage failed'),
+        ('seconds', 'gauge', 'Wall time spent in the stage'),
+        ('self_seconds', 'gauge', 'Wall time spent in the stage minus nested stages'),
+        ('rows', 'gauge', 'Rows processed by the stage'),
+        ('bytes', 'gauge', 'Bytes processed by the stage'),
+        ('peak_rss_bytes', 'gauge', 'Highest process resident set size sampled while the stage was open'),
+    ]
+    fields = {field for field, _, _ in metrics}
+    for field, metric_type, description in metrics:
+        metric = f"prefect_stage_{field}"
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for entry in summary:
+            labels = {'flow': flow_name, **{k: v for k, v in entry.items() if k not in fields and not k.endswith('_per_second')}}
+            label_text = ",".join(f'{re.sub(r"[^a-zA-Z0-9_]", "_", k)}="{_label_value(v)}"' for k, v in labels.items())
+            lines.append(f"{metric}{{{label_text}}} {entry[field]}")
+    return "\n".join(lines) + "\n"
+
+
+# Write the run's metrics to <output_dir>/<flow_name>_metrics.prom (replaced every run, for
+# the textfile collector) and append them as one JSON line to <flow_name>_metrics.jsonl,
+# which keeps the run-over-run history. Returns the summary.
+def write_metrics(flow_name, output_dir='.'):
+    summary = metrics_summary()
+    os.makedirs(output_dir or '.', exist_ok=True)
+
+    prom_file = os.path.join(output_dir, f"{flow_name}_metrics.prom")
+    tmp_file = f"{prom_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(format_prometheus(flow_name, summary))
+    os.replace(tmp_file, prom_file)
+
+    with open(os.path.join(output_dir, f"{flow_name}_metrics.jsonl"), 'a') as f:
+        f.write(json.dumps({'flow': flow_name, 'finished_at': datetime.now().isoformat(), 'stages': summary}, default=str) + "\n")
+    return summary
+
+
+# Publish the stage table as a Prefect artifact of the current flow run
+def create_metrics_artifact(flow_name, summary):
+    try:
+        from prefect.artifacts import create_table_artifact
+        create_table_artifact(
+            key=re.sub(r'[^a-z0-9-]', '-', f"{flow_name}-stage-metrics".lower()),
+            table=summary,
+            description=f"Per-stage wall time, rows, bytes and peak RSS of {flow_name}",
+        )
+    except Exception as e:
+        logger.warning(f"Could not create the metrics artifact for {flow_name}: {e}")
+
+
+# Dump and publish the metrics at the end of a flow run
+def publish_metrics(flow_name, output_dir='.'):
+    try:
+        summary = write_metrics(flow_name, output_dir)
+    except OSError as e:
+        logger.error(f"Could not write metrics for {flow_name}: {e}")
+        summary = metrics_summary()
+    create_metrics_artifact(flow_name, summary)
+    return summary
@@ -0,0 +1,205 @@
+import os
+import io
+import time
+import pstats
+import logging
+import cProfile
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import add_stage_hook, remove_stage_hook
+
+logger = logging.getLogger(__name__)
+
+# Profiling mode for the flows. When a flow starts profiling (flow parameter `profile` or
+# the PREFECT_FLOW_PROFILE environment variable), every task decorated with @profiled runs
+# under a profiler and the fetch / DataFrame / export stages get tracemalloc snapshots:
+#
+#   cprofile      deterministic profiler; <task>_<n>.prof (pstats/snakeviz) + <task>_<n>.txt
+#   pyinstrument  sampling profiler (pip install pyinstrument); <task>_<n>.html + <task>_<n>.txt
+#
+# Output goes to profile_<flow>_<timestamp>/ next to the run logs, with allocations.txt
+# listing the largest allocations per stage. Set PREFECT_FLOW_PROFILE_ALLOCATIONS=0 to
+# profile without tracemalloc, which slows allocation-heavy code down considerably.
+# Profilers only see the thread the task runs on; helper threads (parallel exports,
+# index builds) are not included.
+
+PROFILE_ENV = 'PREFECT_FLOW_PROFILE'
+ALLOCATIONS_ENV = 'PREFECT_FLOW_PROFILE_ALLOCATIONS'
+PROFILE_MODES = ('cprofile', 'pyinstrument')
+
+# Stages that get allocation snapshots, and how many snapshot pairs are kept per stage
+# (snapshots of a large heap take seconds, the peak is tracked on every call)
+TRACED_STAGES = ('sybase_fetch', 'dataframe_build', 'export_write')
+MAX_SNAPSHOTS_PER_STAGE = 1
+TOP_ALLOCATIONS = 15
+TOP_FUNCTIONS = 40
+
+_SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+]
+
+_active = None      # settings of the running profiling session
+_lock = threading.Lock()
+
+
+# Profiling mode for a flow run: the flow parameter if given, else the environment variable
+def resolve_profile_mode(profile=None):
+    mode = (profile or os.environ.get(PROFILE_ENV) or '').strip().lower()
+    if mode in ('', '0', 'n', 'no', 'off', 'false'):
+        return None
+    if mode in ('1', 'y', 'yes', 'on', 'true'):
+        return 'cprofile'
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unsupported profile mode '{mode}'. Supported modes are {', '.join(PROFILE_MODES)}.")
+    return mode
+
+
+def _allocation_hook(name, labels):
+    session = _active
+    if session is None or name not in TRACED_STAGES or not tracemalloc.is_tracing():
+        return _no_snapshot()
+    return _allocation_snapshot(session, name, labels)
+
+
+@contextmanager
+def _no_snapshot():
+    yield
+
+
+@contextmanager
+def _allocation_snapshot(session, name, labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        entry = session['allocations'].setdefault(key, {'calls': 0, 'peak': 0, 'diffs': []})
+        entry['calls'] += 1
+        take_snapshot = len(entry['diffs']) < MAX_SNAPSHOTS_PER_STAGE
+
+    before = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS) if take_snapshot else None
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        _, peak = tracemalloc.get_traced_memory()   # process-wide: includes other threads
+        diff = None
+        if before is not None:
+            after = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+            diff = after.compare_to(before, 'lineno')[:TOP_ALLOCATIONS]
+        with _lock:
+            entry['peak'] = max(entry['peak'], peak)
+            if diff is not None:
+                entry['diffs'].append(diff)
+
+
+# Start profiling for a flow run. Returns the output directory, or None when mode is None.
+def start_profiling(flow_name, mode, log_dir='.'):
+    global _active
+    if mode is None:
+        return None
+
+    output_dir = os.path.join(log_dir or '.', f"profile_{flow_name}_{datetime.now():%Y%m%d_%H%M%S}")
+    os.makedirs(output_dir, exist_ok=True)
+    trace_allocations = os.environ.get(ALLOCATIONS_ENV, '1').strip().lower() not in ('0', 'n', 'no', 'off', 'false')
+    if trace_allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()     # one frame per allocation is enough for the per-line report
+    _active = {
+        'flow': flow_name, 'mode': mode, 'output_dir': output_dir,
+        'counters': {}, 'allocations': {}, 'trace_allocations': trace_allocations,
+    }
+    add_stage_hook(_allocation_hook)
+    logger.info(f"Profiling {flow_name} with {mode}, output in {output_dir}")
+    return output_dir
+
+
+def _write_allocation_report(session):
+    lines = [f"Largest allocations per stage ({session['flow']}), first {MAX_SNAPSHOTS_PER_STAGE} call(s) of each stage", ""]
+    for (name, labels), entry in sorted(session['allocations'].items(), key=lambda item: -item[1]['peak']):
+        label_text = ", ".join(f"{k}={v}" for k, v in labels)
+        lines.append(f"== {name} [{label_text}] calls={entry['calls']} peak traced={entry['peak'] / 1024 / 1024:.1f} MiB")
+        for index, diff in enumerate(entry['diffs'], 1):
+            lines.append(f"-- call {index}")
+            lines.extend(f"   {stat}" for stat in diff)
+        lines.append("")
+    with open(os.path.join(session['output_dir'], 'allocations.txt'), 'w') as f:
+        f.write("\n".join(lines))
+
+
+# Stop profiling and write the allocation report. Returns the output directory.
+def stop_profiling():
+    global _active
+    session, _active = _active, None
+    if session is None:
+        return None
+    remove_stage_hook(_allocation_hook)
+    if session['trace_allocations']:
+        _write_allocation_report(session)
+        tracemalloc.stop()
+    logger.info(f"Profiles of {session['flow']} written to {session['output_dir']}")
+    return session['output_dir']
+
+
+def _profile_path(session, task_name):
+    with _lock:
+        count = session['counters'][task_name] = session['counters'].get(task_name, 0) + 1
+    return os.path.join(session['output_dir'], f"{task_name}_{count}")
+
+
+def _run_cprofile(session, task_name, fn, args, kwargs):
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:     # another profiler is active (tasks running in parallel)
+        logger.warning(f"Not profiling {task_name}: {e}")
+        return fn(*args, **kwargs)
+
+    started = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        path = _profile_path(session, task_name)
+        profiler.dump_stats(f"{path}.prof")
+        report = io.StringIO()
+        report.write(f"{task_name}: {time.perf_counter() - started:.2f}s wall\n\n")
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        with open(f"{path}.txt", 'w') as f:
+            f.write(report.getvalue())
+
+
+def _run_pyinstrument(session, task_name, fn, args, kwargs):
+    from pyinstrument import Profiler      # optional dependency, only for profile=pyinstrument
+
+    profiler = Profiler()
+    try:
+        profiler.start()
+    except RuntimeError as e:   # another profiler is active on this thread
+        logger.warning(f"Not profiling {task_name}: {e}")
+        return fn(*args, **kwargs)
+
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.stop()
+        path = _profile_path(session, task_name)
+        with open(f"{path}.html", 'w') as f:
+            f.write(profiler.output_html())
+        with open(f"{path}.txt", 'w') as f:
+            f.write(profiler.output_text(unicode=False, color=False))
+
+
+# Decorator for task functions (place it below @task). A no-op unless profiling is active.
+def profiled(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        session = _active
+        if session is None:
+            return fn(*args, **kwargs)
+        if session['mode'] == 'pyinstrument':
+            return _run_pyinstrument(session, fn.__name__, fn, args, kwargs)
+        return _run_cprofile(session, fn.__name__, fn, args, kwargs)
+    return wrapper
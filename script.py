@@ -4,8 +4,23 @@ import sqlalchemy
 from sqlalchemy import create_engine, text
 import pyodbc
 from logger import setup_logger
+from connection_pool import get_pool
+from metrics import stage, add_to_stage
+from arrow_types import arrow_type_for
 from urllib.parse import quote_plus
 import hashlib
+import io
+import struct
+import datetime
+import decimal
+import json
+import os
+import threading
+import time
+import weakref
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 from cryptography.fernet import Fernet
 
 logger = setup_logger()
@@ -14,6 +29,13 @@ logger = setup_logger()
 encryption_key = b'gR6SMvY_sacACYRTVHU8-nvfP1ZupxazhKVV-mzH68U='
 cipher = Fernet(encryption_key)
 
+# Rows fetched per cursor.fetchmany() call when a query runs in streaming mode
+DEFAULT_FETCH_BATCH_SIZE = 50000
+
+# Local file holding per-query run state such as incremental high-water marks
+DEFAULT_STATE_FILE = "etl_state.json"
+_state_lock = threading.Lock()
+
 # Function to decrypt passwords
 def decrypt_password(encrypted_password, cipher):
     return cipher.decrypt(encrypted_password.encode()).decode()
@@ -25,96 +47,572 @@ def load_config():
 def get_sybase_connection(sybase_config):
     decrypted_db_password = decrypt_password(sybase_config['password'], cipher)
     driver = "SQL Anywhere 17"  # change this to your actual installed driver
-    return pyodbc.connect(f'Driver={driver};Server={sybase_config["ims_service_name"]};Database={sybase_config["database"]};UID={sybase_config["user"]};PWD={decrypted_db_password};')
+    connection_string = f'Driver={driver};Server={sybase_config["ims_service_name"]};Database={sybase_config["database"]};UID={sybase_config["user"]};PWD={decrypted_db_password};'
+    pool_config = sybase_config.get('pool')
+    if pool_config:
+        # Draw from the shared connection pool; close() hands the connection back to it
+        return get_pool(connection_string, **pool_config).acquire()
+    return pyodbc.connect(connection_string)
    
+# Engines already created in this worker process, keyed by URL and engine options, so that
+# repeated flows reuse warm connection pools
+_engines = {}
+_engines_lock = threading.Lock()
+# Server-side settings applied to every loading transaction, per engine
+_load_session_settings = weakref.WeakKeyDictionary()
+
+
+# Create (or reuse) the engine for the postgres config. The optional `engine` section is
+# passed to create_engine (pool_size, max_overflow, pool_pre_ping, pool_recycle,
+# executemany_mode, insertmanyvalues_page_size, ...), and `session_settings`
+# (e.g. synchronous_commit, work_mem) are applied to each loading transaction.
 def get_postgres_engine(cfg):
     decrypted_db_password = decrypt_password(cfg['password'], cipher)
     password = quote_plus(decrypted_db_password)  # encodes special chars like @
     url = f"postgresql://{cfg['user']}:{password}@{cfg['host']}:{cfg['port']}/{cfg['database']}"
-    return create_engine(url)
 
-def execute_postgres_procedures(engine, procedures):
-    success = True  # Track overall success/failure
+    engine_options = cfg.get('engine', {}) or {}
+    cache_key = (url, json.dumps(engine_options, sort_keys=True, default=str))
+    with _engines_lock:
+        engine = _engines.get(cache_key)
+        if engine is None:
+            engine = create_engine(url, **engine_options)
+            _engines[cache_key] = engine
+        _load_session_settings[engine] = cfg.get('session_settings', {}) or {}
+    return engine
+
+
+# Apply the engine's session_settings to the current transaction only (SET LOCAL semantics),
+# so pooled connections go back to the pool with their defaults
+def apply_session_settings(conn):
+    for name, value in _load_session_settings.get(conn.engine, {}).items():
+        if isinstance(value, bool):  # YAML reads a bare off/on as a boolean
+            value = 'on' if value else 'off'
+        conn.execute(text("SELECT set_config(:name, :value, true)"), {'name': name, 'value': str(value)})
+
+# Run one entry of postgres_procedures in its own transaction
+def execute_postgres_procedure(engine, proc):
+    schema = proc.get("schema", "public")
+    name = proc["name"]
+    args = proc.get("arguments", [])
+    arg_placeholders = ", ".join([f":arg{i}" for i in range(len(args))])
+    sql = text(f"CALL {schema}.{name}({arg_placeholders})") if args else text(f"CALL {schema}.{name}()")
+
+    logger.info(f"Executing PostgreSQL procedure: {schema}.{name}({', '.join(map(str, args))})")
+    with stage('postgres_procedure', procedure=f"{schema}.{name}"), engine.begin() as conn:
+        conn.execute(sql, {f"arg{i}": arg for i, arg in enumerate(args)})
+
+
+def procedure_key(proc):
+    return f"{proc.get('schema', 'public')}.{proc['name']}"
+
+
+# Dependencies of every procedure: {key: {('procedure', key) | ('table', name), ...}}.
+# depends_on lists procedures (name or schema.name) and target tables; a procedure without
+# depends_on waits for every target table and for the procedure listed before it.
+def procedure_dependencies(procedures, queries=()):
+    names = {}
+    for proc in procedures:
+        names[proc['name']] = names[procedure_key(proc)] = procedure_key(proc)
+    target_tables = {item.get('target_table', item['name']) for item in queries or []}
+
+    dependencies = {}
+    previous = None
+    for proc in procedures:
+        key = procedure_key(proc)
+        if 'depends_on' in proc:
+            depends_on = set()
+            for name in proc['depends_on'] or []:
+                if name in names:
+                    depends_on.add(('procedure', names[name]))
+                elif name in target_tables:
+                    depends_on.add(('table', name))
+                else:
+                    raise ValueError(f"postgres_procedure {key} depends on '{name}', which is neither "
+                                     f"a configured procedure nor a query target_table")
+        else:
+            depends_on = {('table', table) for table in target_tables}
+            if previous is not None:
+                depends_on.add(('procedure', previous))
+        dependencies[key] = depends_on
+        previous = key
+
+    # Reject cycles up front, they would never start
+    visiting, visited = [], set()
+
+    def visit(key):
+        if key in visiting:
+            cycle = visiting[visiting.index(key):] + [key]
+            raise ValueError(f"postgres_procedures depend on each other in a cycle: {' -> '.join(cycle)}")
+        if key in visited:
+            return
+        visiting.append(key)
+        for kind, name in dependencies[key]:
+            if kind == 'procedure':
+                visit(name)
+        visiting.pop()
+        visited.add(key)
+
+    for key in dependencies:
+        visit(key)
+    return dependencies
+
+
+# Runs postgres_procedures as a DAG, up to max_workers at a time, each procedure in its own
+# transaction. A procedure starts once the procedures and target tables it depends on are
+# done: tables are reported with query_loaded()/table_loaded() while the extraction is still
+# running, and wait() treats every remaining table as loaded. Dependents of a failed
+# procedure are skipped.
+# A procedure with skip_unchanged is also skipped when none of its inputs changed since it
+# last succeeded: its tables were loaded no later than that (by their changed_at in the
+# state file) and none of the procedures it depends on ran in this run.
+class ProcedureRunner:
+    def __init__(self, engine, procedures, queries=(), max_workers=1, etl_cfg=None):
+        self.engine = engine
+        self.procedures = {procedure_key(proc): proc for proc in procedures}
+        self.dependencies = procedure_dependencies(procedures, queries)
+        self.queries = list(queries or [])
+        self.etl_cfg = etl_cfg
+        self.target_tables = {item.get('target_table', item['name']) for item in self.queries}
+        self.state_file = query_option({}, etl_cfg, 'state_file', DEFAULT_STATE_FILE)
+        self._skipped = set()
+        self._done = set()
+        self._waiting = set(self.procedures)
+        self._running = 0
+        self._failed = set()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix="pg-procedure")
+        with self._condition:
+            self._start_ready()
+
+    def _start_ready(self):
+        # Called with the lock held
+        changed = True
+        while changed:
+            changed = False
+            for key in sorted(self._waiting):
+                dependencies = self.dependencies[key]
+                failed = [name for kind, name in dependencies if kind == 'procedure' and name in self._failed]
+                if failed:
+                    logger.error(f"Skipping PostgreSQL procedure {key}: {', '.join(failed)} failed")
+                    self._waiting.discard(key)
+                    self._failed.add(key)
+                    changed = True
+                elif dependencies <= self._done:
+                    self._waiting.discard(key)
+                    changed = True
+                    if self.procedures[key].get('skip_unchanged') and self._inputs_unchanged(key):
+                        logger.info(f"Skipping PostgreSQL procedure {key}: its inputs are unchanged since its last run")
+                        self._skipped.add(key)
+                        self._done.add(('procedure', key))
+                        continue
+                    self._running += 1
+                    self._executor.submit(self._run, key)
+        self._condition.notify_all()
+
+    def _inputs_unchanged(self, key):
+        state = load_etl_state(self.state_file)
+        last_success = state.get(f"procedure:{key}", {}).get('succeeded_at')
+        if last_success is None:
+            return False
+        for kind, name in self.dependencies[key]:
+            if kind == 'procedure' and name not in self._skipped:
+                return False
+            if kind == 'table':
+                changed_at = state.get(name, {}).get('changed_at')
+                if changed_at is None or changed_at > last_success:
+                    return False
+        return True
+
+    def _run(self, key):
+        try:
+            execute_postgres_procedure(self.engine, self.procedures[key])
+            if self.procedures[key].get('skip_unchanged'):
+                update_etl_state(self.state_file, f"procedure:{key}", {'succeeded_at': datetime.datetime.now().isoformat()})
+            failed = False
+        except Exception as e:
+            logger.error(f"Failed to execute PostgreSQL procedure {key}: {e}")
+            failed = True
+        with self._condition:
+            self._running -= 1
+            if failed:
+                self._failed.add(key)
+            else:
+                self._done.add(('procedure', key))
+            self._start_ready()
+
+    def table_loaded(self, table_name):
+        with self._condition:
+            self._done.add(('table', table_name))
+            self._start_ready()
+
+    # A query's table is ready for the procedures once it is loaded and indexed, so queries
+    # that defer their index build are only reported by wait()
+    def query_loaded(self, item):
+        if not query_option(item, self.etl_cfg, 'defer_index_builds', False):
+            self.table_loaded(item.get('target_table', item['name']))
+
+    # Run the remaining procedures and wait for all of them. Returns False if any failed.
+    def wait(self):
+        with self._condition:
+            self._done.update(('table', name) for name in self.target_tables)
+            self._start_ready()
+            self._condition.wait_for(lambda: not self._waiting and not self._running)
+        self._executor.shutdown(wait=True)
+        return not self._failed
+
+
+def execute_postgres_procedures(engine, procedures, max_workers=1, queries=()):
+    return ProcedureRunner(engine, procedures, queries, max_workers=max_workers).wait()
+
+
+# Build a PostgreSQL index name, shortened with a hash when it exceeds the 63 character limit
+def build_index_name(index_prefix, column, suffix='idx'):
+    base_name = f"{index_prefix}_{column}_{suffix}"
+    if len(base_name) > 63:
+        hash_suffix = hashlib.md5(base_name.encode()).hexdigest()[:6]
+        index_name = f"{index_prefix}_{column[:20]}_{hash_suffix}"
+    else:
+        index_name = base_name
+
+    return index_name.lower()
+
+
+# Turn the configured index_columns into index definitions. Each entry is either a column
+# name or a mapping such as {columns: [a, b], where: "a IS NOT NULL", unique: false, name: ...}.
+def normalize_index_definitions(index_columns, index_prefix):
+    definitions = []
+    for entry in index_columns or []:
+        if isinstance(entry, str):
+            entry = {'columns': [entry]}
+        columns = entry.get('columns') or [entry['column']]
+        definitions.append({
+            'name': (entry.get('name') or build_index_name(index_prefix, "_".join(columns))).lower(),
+            'columns': columns,
+            'where': entry.get('where'),
+            'unique': entry.get('unique', False),
+        })
+    return definitions
+
+
+# Index names per (schema, table), filled from pg_indexes on first use and kept up to date by
+# create_indexes/drop_indexes, so the catalog is not queried again on every call.
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+
+
+def clear_index_cache(table_name=None, schema='public'):
+    with _index_cache_lock:
+        if table_name is None:
+            _index_cache.clear()
+        else:
+            _index_cache.pop((schema, table_name), None)
+
+
+def get_existing_indexes(conn, table_name, schema='public'):
+    with _index_cache_lock:
+        cached = _index_cache.get((schema, table_name))
+    if cached is not None:
+        return cached
+
+    existing_indexes = conn.execute(text("""
+        SELECT indexname
+        FROM pg_indexes
+        WHERE tablename = :table_name AND schemaname = :schema
+    """), {'table_name': table_name, 'schema': schema}).fetchall()
+
+    existing_index_names = {row[0].lower() for row in existing_indexes}
+    with _index_cache_lock:
+        _index_cache[(schema, table_name)] = existing_index_names
+    return existing_index_names
+
+
+# Indexes of a table left INVALID by a failed CREATE INDEX CONCURRENTLY. They still show up in
+# pg_indexes, so IF NOT EXISTS would skip them; always read from the catalog, never cached.
+def get_invalid_indexes(conn, table_name, schema='public'):
+    invalid_indexes = conn.execute(text("""
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_class t ON t.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        WHERE t.relname = :table_name AND n.nspname = :schema AND NOT i.indisvalid
+    """), {'table_name': table_name, 'schema': schema}).fetchall()
+    return {row[0].lower() for row in invalid_indexes}
+
+
+def _create_index_sql(definition, table_name, schema, concurrently):
+    unique = "UNIQUE " if definition['unique'] else ""
+    concurrent = "CONCURRENTLY " if concurrently else ""
+    column_list = ", ".join(f'"{column}"' for column in definition['columns'])
+    where = f" WHERE {definition['where']}" if definition['where'] else ""
+    return f"""
+        CREATE {unique}INDEX {concurrent}IF NOT EXISTS "{definition['name']}"
+        ON "{schema}"."{table_name}" ({column_list}){where};
+    """
+
+
+# Create the configured indexes that do not exist yet, dropping and rebuilding any that an
+# earlier failed build left INVALID. With concurrently=True the indexes are built with
+# CREATE INDEX CONCURRENTLY, which cannot run inside a transaction block.
+def create_indexes(engine, table_name, index_columns, index_prefix, schema='public', concurrently=False):
+    #index_prefix = cfg.get('index_prefix', 'idx')
+
+    if not index_columns:
+        return
+
+    if concurrently:
+        connection = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    else:
+        connection = engine.begin()
+
+    with connection as conn:
+        if not concurrently:
+            apply_session_settings(conn)
+        existing_index_names = get_existing_indexes(conn, table_name, schema)
+        invalid_index_names = get_invalid_indexes(conn, table_name, schema)
+
+        for definition in normalize_index_definitions(index_columns, index_prefix):
+            index_name = definition['name']
+
+            if index_name in invalid_index_names:
+                logger.warning(f"Index {index_name} on {table_name} is invalid, rebuilding it")
+                concurrent = "CONCURRENTLY " if concurrently else ""
+                conn.execute(text(f'DROP INDEX {concurrent}IF EXISTS "{schema}"."{index_name}"'))
+                existing_index_names.discard(index_name)
+
+            if index_name not in existing_index_names:
+                print(f"Creating index: {index_name} on {', '.join(definition['columns'])}")
+                with stage('index_build', table=table_name):
+                    conn.execute(text(_create_index_sql(definition, table_name, schema, concurrently)))
+                existing_index_names.add(index_name)
+            else:
+                print(f"Index {index_name} already exists. Skipping.")
+
+
+# Drop the configured indexes of a table, e.g. before a bulk load that rebuilds them afterwards
+def drop_indexes(engine, table_name, index_columns, index_prefix, schema='public'):
+    if not index_columns:
+        return
+
     with engine.begin() as conn:
-        for proc in procedures:
-            schema = proc.get("schema", "public")
-            name = proc["name"]
-            args = proc.get("arguments", [])
-            arg_placeholders = ", ".join([f":arg{i}" for i in range(len(args))])
-            sql = text(f"CALL {schema}.{name}({arg_placeholders})") if args else text(f"CALL {schema}.{name}()")
-
-            logger.info(f"Executing PostgreSQL procedure: {schema}.{name}({', '.join(map(str, args))})")
+        existing_index_names = get_existing_indexes(conn, table_name, schema)
+
+        for definition in normalize_index_definitions(index_columns, index_prefix):
+            index_name = definition['name']
+            if index_name in existing_index_names:
+                logger.info(f"Dropping index: {index_name} before bulk load")
+                conn.execute(text(f'DROP INDEX IF EXISTS "{schema}"."{index_name}"'))
+                existing_index_names.discard(index_name)
+
+
+# Build the indexes of several tables in parallel. jobs is a list of
+# (table_name, index_columns, index_prefix, concurrently) tuples. Returns False if any build failed.
+def build_indexes_parallel(engine, jobs, max_workers=4):
+    jobs = [job for job in jobs if job[1]]
+    if not jobs:
+        return True
+
+    success = True
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="index-build") as executor:
+        futures = {
+            executor.submit(create_indexes, engine, table_name, index_columns, index_prefix, concurrently=concurrently): table_name
+            for table_name, index_columns, index_prefix, concurrently in jobs
+        }
+        for future in as_completed(futures):
             try:
-                conn.execute(sql, {f"arg{i}": arg for i, arg in enumerate(args)})
+                future.result()
             except Exception as e:
-                logger.error(f"Failed to execute PostgreSQL procedure {schema}.{name}: {e}")
+                logger.error(f"Failed to build indexes on {futures[future]}: {e}")
                 success = False
     return success
 
 
-def create_indexes(engine, table_name, index_columns, index_prefix, schema='public'):
-    #index_prefix = cfg.get('index_prefix', 'idx')
+# Index handling around the load of one query. With defer_index_builds the configured
+# indexes are dropped before the load and rebuilt later by rebuild_deferred_indexes.
+def drop_query_indexes(postgres_engine, item, etl_cfg=None):
+    if query_option(item, etl_cfg, 'defer_index_builds', False):
+        target_table = item.get('target_table', item['name'])
+        drop_indexes(postgres_engine, target_table, item.get('index_columns', []), item.get('index_prefix', 'idx'))
 
-    if not index_columns:
+
+def create_query_indexes(postgres_engine, item, etl_cfg=None):
+    if query_option(item, etl_cfg, 'defer_index_builds', False):
         return
+    target_table = item.get('target_table', item['name'])
+    create_indexes(postgres_engine, target_table, item.get('index_columns', []), item.get('index_prefix', 'idx'),
+                   concurrently=query_option(item, etl_cfg, 'concurrent_index_builds', False))
 
-    with engine.begin() as conn:
-        existing_indexes = conn.execute(text("""
-            SELECT indexname
-            FROM pg_indexes
-            WHERE tablename = :table_name AND schemaname = :schema
-        """), {'table_name': table_name, 'schema': schema}).fetchall()
-
-        existing_index_names = {row[0].lower() for row in existing_indexes}
-
-        for column in index_columns:
-            base_name = f"{index_prefix}_{column}_idx"
-            if len(base_name) > 63:
-                hash_suffix = hashlib.md5(base_name.encode()).hexdigest()[:6]
-                index_name = f"{index_prefix}_{column[:20]}_{hash_suffix}"
+
+# Rebuild, in one parallel pass, the indexes of every query that deferred its index build
+def rebuild_deferred_indexes(postgres_engine, queries, etl_cfg=None):
+    etl_cfg = etl_cfg or {}
+    jobs = [
+        (item.get('target_table', item['name']), item.get('index_columns', []), item.get('index_prefix', 'idx'),
+         query_option(item, etl_cfg, 'concurrent_index_builds', False))
+        for item in queries
+        if query_option(item, etl_cfg, 'defer_index_builds', False)
+    ]
+    return build_indexes_parallel(
+        postgres_engine, jobs,
+        max_workers=int(etl_cfg.get('index_build_workers', 4))
+    )
+
+# Execute the configured view/procedure and move to the first result set.
+# Returns the column names of that result set, or None when nothing was returned.
+def open_sybase_result(cursor, item):
+    with stage('sybase_execute', query=item['name']):
+        if item['type'].lower() == 'view':
+            if item.get('filter'):  # e.g. incremental watermark condition
+                query = f"SELECT * FROM dba.{item['name']} WHERE {item['filter']};"
+                logger.info(f"Executing Sybase view - {item['name']} where {item['filter']} {item.get('arguments', [])}")
+                cursor.execute(query, item.get('arguments', []))
             else:
-                index_name = base_name
+                query = f"SELECT * FROM dba.{item['name']};"
+                logger.info(f"Executing Sybase view - {item['name']}")
+                cursor.execute(query)
+        else:  # stored procedure
+            args = item.get("arguments", [])
+            placeholders = ", ".join(["?" for _ in args])  # assuming pyodbc
+            print(placeholders);
+            query = f"CALL dba.{item['name']}({placeholders});"
+            logger.info(f"Executing Sybase procedure - {item['name']} with args {args}")
+            cursor.execute(query, args)
 
-            index_name = index_name.lower()
+        # Loop through results until we find a result set with a description
+        while cursor.description is None:
+            if not cursor.nextset():
+                logger.error(f"No result set returned for {item['name']}")
+                return None
 
-            if index_name not in existing_index_names:
-                print(f"Creating index: {index_name} on {column}")
-                conn.execute(text(f"""
-                    CREATE INDEX "{index_name}"
-                    ON "{schema}"."{table_name}" ("{column}");
-                """))
+    return [col[0] for col in cursor.description]
+
+
+# ---- Columnar, dtype-aware materialization of result rows ----
+
+# NumPy dtype a column is filled into, and the value its NULL cells hold. Integer and
+# boolean columns hold 0/False and are masked afterwards; decimals with a scale (or too
+# wide for int64) and every other type stay Python objects.
+def _numpy_column_kind(type_code, precision, scale):
+    if type_code is bool:
+        return np.bool_, False
+    if type_code is int or (type_code is decimal.Decimal and not scale and precision and precision <= 18):
+        return np.int64, 0
+    if type_code is float:
+        return np.float64, np.nan
+    if type_code is datetime.datetime:
+        return np.dtype('datetime64[us]'), np.datetime64('NaT')
+    if type_code is datetime.date:
+        return np.dtype('datetime64[D]'), np.datetime64('NaT')
+    return object, None
+
+
+# Fill one preallocated array (and NULL mask) per column in a single pass over the rows,
+# without transposing them into intermediate per-column lists first
+def _fill_columns(rows, kinds):
+    row_count = len(rows)
+    arrays = [np.empty(row_count, dtype=dtype) for dtype, _ in kinds]
+    masks = [np.zeros(row_count, dtype=np.bool_) for _ in kinds]
+    null_values = [null_value for _, null_value in kinds]
+    # Decimals filled into int64 columns need an explicit conversion
+    converters = [int if dtype is np.int64 else None for dtype, _ in kinds]
+    columns = list(zip(arrays, masks, null_values, converters))
+    for i, row in enumerate(rows):
+        for (values, mask, null_value, convert), value in zip(columns, row):
+            if value is None:
+                mask[i] = True
+                values[i] = null_value
             else:
-                print(f"Index {index_name} already exists. Skipping.")
+                values[i] = convert(value) if convert else value
+    return arrays, masks
+
+
+def _numpy_column(values, mask, dtype):
+    if not mask.any():
+        return values
+    if dtype is np.int64:
+        return pd.arrays.IntegerArray(values, mask)
+    if dtype is np.bool_:
+        return pd.arrays.BooleanArray(values, mask)
+    return values      # NULLs are already NaN / NaT / None
+
+
+# Column types for the numpy columns to_sql would not create by itself: dates (pandas keeps
+# datetime64[D] at second resolution, so they would become timestamps) and exact decimals
+def _numpy_sql_type(type_code, precision, scale):
+    if type_code is datetime.date:
+        return sqlalchemy.Date()
+    if type_code is decimal.Decimal and (scale or not precision or precision > 18):
+        return sqlalchemy.Numeric(precision, scale) if precision else sqlalchemy.Numeric()
+    return None
+
+
+# Build an Arrow table from result rows, one typed Arrow array per column. Booleans,
+# integers, floats and timestamps are filled into NumPy arrays first; decimals, dates and
+# strings are handed to Arrow as Python objects.
+def rows_to_arrow_table(rows, description):
+    import pyarrow as pa    # optional dependency, only needed for materialize: arrow
+
+    kinds = []
+    for desc in description:
+        dtype, null_value = _numpy_column_kind(desc[1], desc[4], desc[5])
+        if desc[1] is decimal.Decimal or desc[1] is datetime.date:
+            dtype, null_value = object, None
+        kinds.append((dtype, null_value))
+    arrays, masks = _fill_columns(rows, kinds)
+
+    columns = []
+    for values, mask, (dtype, _), desc in zip(arrays, masks, kinds, description):
+        arrow_type = arrow_type_for(pa, desc[1], desc[4], desc[5])
+        if dtype is object:
+            columns.append(pa.array(values, type=arrow_type))
+        else:
+            columns.append(pa.array(values, type=arrow_type, mask=mask))
+    return pa.Table.from_arrays(columns, names=[desc[0] for desc in description])
+
+
+# Turn result rows into a DataFrame with real dtypes taken from cursor.description instead
+# of object columns of boxed values. backend 'numpy' fills one typed NumPy array per column
+# (nullable Int64/boolean where NULLs occur, datetime64 for dates, decimals with a scale stay
+# Decimal objects) and records the column types to create tables with in df.attrs['sql_types'];
+# backend 'arrow' builds Arrow arrays (exact decimal128, date32, ...) and returns an
+# Arrow-backed DataFrame. Either way the rows are read once, straight into the column arrays.
+def materialize_rows(rows, description, backend='numpy'):
+    names = [desc[0] for desc in description]
+    if backend == 'arrow':
+        return rows_to_arrow_table(rows, description).to_pandas(types_mapper=pd.ArrowDtype)
+    if backend != 'numpy':
+        raise ValueError(f"Unsupported materialize backend '{backend}'. Supported backends are numpy, arrow.")
+
+    kinds = [_numpy_column_kind(desc[1], desc[4], desc[5]) for desc in description]
+    arrays, masks = _fill_columns(rows, kinds)
+    df = pd.DataFrame({
+        name: _numpy_column(values, mask, dtype)
+        for name, values, mask, (dtype, _) in zip(names, arrays, masks, kinds)
+    }, columns=names)
+    sql_types = {desc[0]: _numpy_sql_type(desc[1], desc[4], desc[5]) for desc in description}
+    df.attrs['sql_types'] = {name: sql_type for name, sql_type in sql_types.items() if sql_type is not None}
+    return df
+
+
+def execute_sybase_query(cursor, item, materialize=None):
+    columns = open_sybase_result(cursor, item)
+    if columns is None:
+        return pd.DataFrame()
 
-def execute_sybase_query(cursor, item):
-    if item['type'].lower() == 'view':
-        query = f"SELECT * FROM dba.{item['name']};"
-        logger.info(f"Executing Sybase view - {item['name']}")
-        cursor.execute(query)
-    else:  # stored procedure
-        args = item.get("arguments", [])
-        placeholders = ", ".join(["?" for _ in args])  # assuming pyodbc
-        print(placeholders);
-        query = f"CALL dba.{item['name']}({placeholders});"
-        logger.info(f"Executing Sybase procedure - {item['name']} with args {args}")
-        cursor.execute(query, args)
-
-
-    # Loop through results until we find a result set with a description
-    while cursor.description is None:
-        if not cursor.nextset():
-            logger.error(f"No result set returned for {item['name']}")
-            return pd.DataFrame()
-        
-    columns = [col[0] for col in cursor.description]
     expected_col_count = len(columns)
-    data = cursor.fetchall()
+    with stage('sybase_fetch', query=item['name']) as fetch_stage:
+        data = cursor.fetchall()
+        fetch_stage['rows'] = len(data)
     if data:
         print("First row type:", type(data[0]))
         print("First row length:", len(data[0]))
 
     # Filter out any extra rows like export messages
-    filtered_data = [tuple(row) for row in data if len(row) == expected_col_count]
+    if materialize:
+        filtered_data = [row for row in data if len(row) == expected_col_count]
+    else:
+        filtered_data = [tuple(row) for row in data if len(row) == expected_col_count]
     invalid_rows = [row for row in data if len(row) != expected_col_count]
     if invalid_rows:
         logger.warning(f"{len(invalid_rows)} invalid rows removed from result of {item['name']}")
@@ -123,46 +621,1251 @@ def execute_sybase_query(cursor, item):
         logger.warning(f"No valid rows returned by {item['name']}")
         return pd.DataFrame(columns=columns)
 
-    return pd.DataFrame(filtered_data, columns=columns)
+    with stage('dataframe_build', query=item['name']) as build_stage:
+        if materialize:
+            df = materialize_rows(filtered_data, cursor.description, materialize)
+        else:
+            df = pd.DataFrame(filtered_data, columns=columns)
+        build_stage['rows'] = len(df)
+        build_stage['bytes'] = int(df.memory_usage(index=False).sum())
+    return df
+
+
+# Streaming variant of execute_sybase_query: yields one DataFrame per fetchmany() batch
+# so that only batch_size rows are held in memory at a time.
+def iter_sybase_query_batches(cursor, item, batch_size=DEFAULT_FETCH_BATCH_SIZE, materialize=None):
+    columns = open_sybase_result(cursor, item)
+    if columns is None:
+        return
+
+    description = cursor.description
+    expected_col_count = len(columns)
+    total_rows = 0
+    invalid_count = 0
+
+    while True:
+        with stage('sybase_fetch', query=item['name']) as fetch_stage:
+            rows = cursor.fetchmany(batch_size)
+            fetch_stage['rows'] = len(rows)
+        if not rows:
+            break
+
+        # Filter out any extra rows like export messages, batch by batch
+        if materialize:
+            batch = [row for row in rows if len(row) == expected_col_count]
+        else:
+            batch = [tuple(row) for row in rows if len(row) == expected_col_count]
+        invalid_count += len(rows) - len(batch)
+        if not batch:
+            continue
+
+        total_rows += len(batch)
+        with stage('dataframe_build', query=item['name']) as build_stage:
+            if materialize:
+                df = materialize_rows(batch, description, materialize)
+            else:
+                df = pd.DataFrame(batch, columns=columns)
+            build_stage['rows'] = len(df)
+            build_stage['bytes'] = int(df.memory_usage(index=False).sum())
+        yield df
+
+    if invalid_count:
+        logger.warning(f"{invalid_count} invalid rows removed from result of {item['name']}")
+    if not total_rows:
+        logger.warning(f"No valid rows returned by {item['name']}")
+
+
+class _ProducerError:
+    def __init__(self, error):
+        self.error = error
 
 
-def sync_to_postgres(df, table_name, engine):
+# Run a batch iterator on a background thread and hand its batches over through a bounded
+# queue, so fetching the next batch from Sybase overlaps with loading the current one into
+# Postgres. The producer blocks once max_queued_batches are waiting (backpressure), and
+# errors on either side stop both threads.
+def prefetch_batches(batches, max_queued_batches):
+    batch_queue = queue.Queue(maxsize=max_queued_batches)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                batch_queue.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    break
+            else:
+                put(done)
+        except BaseException as e:
+            put(_ProducerError(e))
+        finally:
+            close = getattr(batches, 'close', None)
+            if close is not None:
+                close()
+
+    producer = threading.Thread(target=produce, name="sybase-fetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            entry = batch_queue.get()
+            if entry is done:
+                break
+            if isinstance(entry, _ProducerError):
+                raise entry.error
+            yield entry
+    finally:
+        stop.set()
+        producer.join()
+
+
+def sync_to_postgres(df, table_name, engine, unlogged=False):
     with engine.begin() as conn:
         print('inside the postgres load block')
+        apply_session_settings(conn)
+        create_unlogged = unlogged and not table_exists(conn, table_name)
         # Create schema if not exists
-        df.head(0).to_sql(table_name, conn, if_exists='append', index=False)
+        df.head(0).to_sql(table_name, conn, if_exists='append', index=False, dtype=table_column_types(df))
+        if create_unlogged:
+            conn.execute(text(f'ALTER TABLE "{table_name}" SET UNLOGGED'))
         # Truncate table
         conn.execute(text(f'TRUNCATE TABLE "{table_name}"'))
         # Load data
         df.to_sql(table_name, conn, if_exists='append', index=False)
         logger.info(f"Loaded {len(df)} rows into PostgreSQL table '{table_name}'")
 
+
+# SQL type for the Arrow types to_sql does not map by itself (it would create exact
+# decimals and dates as text); None for every other type
+def _arrow_sql_type(pa, arrow_type):
+    if pa.types.is_decimal(arrow_type):
+        return sqlalchemy.Numeric(arrow_type.precision, arrow_type.scale)
+    if pa.types.is_date(arrow_type):
+        return sqlalchemy.Date()
+    return None
+
+
+# Column types for creating a table from an Arrow-backed DataFrame
+def arrow_sql_types(df):
+    import pyarrow as pa
+
+    column_types = {}
+    for name, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.ArrowDtype):
+            sql_type = _arrow_sql_type(pa, dtype.pyarrow_dtype)
+            if sql_type is not None:
+                column_types[name] = sql_type
+    return column_types or None
+
+
+# Column types recorded in an Arrow schema, in the form materialize_rows keeps them in
+# df.attrs['sql_types']
+def arrow_schema_sql_types(schema):
+    import pyarrow as pa
+
+    column_types = {}
+    for field in schema:
+        sql_type = _arrow_sql_type(pa, field.type)
+        if sql_type is not None:
+            column_types[field.name] = sql_type
+    return column_types
+
+
+# Column types to create a table for df with: the Arrow types to_sql does not map and the
+# types materialize_rows recorded for numpy columns
+def table_column_types(df):
+    column_types = {}
+    if any(isinstance(dtype, pd.ArrowDtype) for dtype in df.dtypes):
+        column_types.update(arrow_sql_types(df) or {})
+    column_types.update(df.attrs.get('sql_types', {}))
+    return column_types or None
+
+
+# Create the target table from the first batch if it does not exist yet (UNLOGGED when
+# asked to), then empty it
+def prepare_target_table(conn, first_batch, table_name, unlogged=False):
+    create_unlogged = unlogged and not table_exists(conn, table_name)
+    # Create schema if not exists
+    first_batch.head(0).to_sql(table_name, conn, if_exists='append', index=False, dtype=table_column_types(first_batch))
+    if create_unlogged:
+        conn.execute(text(f'ALTER TABLE "{table_name}" SET UNLOGGED'))
+    # Truncate table
+    conn.execute(text(f'TRUNCATE TABLE "{table_name}"'))
+
+
+# Same create-if-missing + TRUNCATE semantics as sync_to_postgres, but the data arrives
+# as an iterable of DataFrame batches. The table is left untouched when no batch arrives.
+# Returns the number of rows loaded.
+def sync_batches_to_postgres(batches, table_name, engine, unlogged=False):
+    batches = iter(batches)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        return 0
+
+    row_count = 0
+    with engine.begin() as conn:
+        apply_session_settings(conn)
+        prepare_target_table(conn, first_batch, table_name, unlogged)
+        # Load data one batch at a time
+        batch = first_batch
+        while batch is not None:
+            batch.to_sql(table_name, conn, if_exists='append', index=False)
+            row_count += len(batch)
+            batch = next(batches, None)
+        logger.info(f"Loaded {row_count} rows into PostgreSQL table '{table_name}'")
+    return row_count
+
+
+# ---- COPY ... FROM STDIN bulk loading ----
+
+# Characters that have to be backslash-escaped in COPY text format
+_COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_BINARY_NULL = struct.pack('!i', -1)
+_PG_EPOCH_DATE = datetime.date(2000, 1, 1)
+_PG_EPOCH = datetime.datetime(2000, 1, 1)
+
+
+def _is_null(value):
+    return value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and value != value)
+
+
+def _copy_text_value(value):
+    if _is_null(value):
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    return str(value).translate(_COPY_TEXT_ESCAPES)
+
+
+# pandas turns integer columns with NULLs into float64, which would be written as '1.0'
+# and rejected by integer columns; write whole numbers without the fraction instead.
+def _copy_text_integer(value):
+    if isinstance(value, (float, decimal.Decimal)) and not _is_null(value) and value == int(value):
+        return str(int(value))
+    return _copy_text_value(value)
+
+
+_COPY_TEXT_INTEGER_TYPES = ('int2', 'int4', 'int8')
+
+
+def _get_text_converters(conn, table_name, columns, schema='public'):
+    column_types = _get_column_types(conn, table_name, schema)
+    return [_copy_text_integer if column_types.get(column) in _COPY_TEXT_INTEGER_TYPES else _copy_text_value
+            for column in columns]
+
+
+def _write_copy_text(df, buffer, converters):
+    for row in df.itertuples(index=False, name=None):
+        buffer.write('\t'.join([convert(value) for value, convert in zip(row, converters)]))
+        buffer.write('\n')
+
+
+def _pg_timestamp_micros(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    delta = value - _PG_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _pg_date_days(value):
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return (value - _PG_EPOCH_DATE).days
+
+
+def _pg_time_micros(value):
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond
+
+
+# NUMERIC in binary COPY: digit count, weight (base-10000 exponent of the first digit), sign,
+# display scale, then the base-10000 digits. The server rounds to the column's typmod.
+def _pg_numeric(value):
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(value if isinstance(value, int) else str(value))
+    if value.is_nan():
+        return struct.pack('!hhHh', 0, 0, 0xC000, 0)
+    if value.is_infinite():
+        return struct.pack('!hhHh', 0, 0, 0xF000 if value < 0 else 0xD000, 0)
+
+    sign, digits, exponent = value.as_tuple()
+    digit_str = ''.join(map(str, digits)) + '0' * max(exponent, 0)
+    frac_len = max(-exponent, 0)
+    display_scale = frac_len
+    # Align the decimal point to a group boundary on both sides, then cut into groups of 4
+    digit_str += '0' * (-frac_len % 4)
+    frac_len += -frac_len % 4
+    int_len = len(digit_str) - frac_len
+    if int_len < 0:
+        digit_str = '0' * -int_len + digit_str
+        int_len = 0
+    digit_str = '0' * (-int_len % 4) + digit_str
+    int_len += -int_len % 4
+
+    groups = [int(digit_str[i:i + 4]) for i in range(0, len(digit_str), 4)]
+    weight = int_len // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        return struct.pack('!hhHh', 0, 0, 0, display_scale)
+    return struct.pack(f'!hhHh{len(groups)}h', len(groups), weight, 0x4000 if sign else 0, display_scale, *groups)
+
+
+# Binary COPY encoders keyed by the PostgreSQL type name (pg_type.typname)
+_COPY_BINARY_ENCODERS = {
+    'int2': lambda v: struct.pack('!h', int(v)),
+    'int4': lambda v: struct.pack('!i', int(v)),
+    'int8': lambda v: struct.pack('!q', int(v)),
+    'float4': lambda v: struct.pack('!f', float(v)),
+    'float8': lambda v: struct.pack('!d', float(v)),
+    'bool': lambda v: b'\x01' if v else b'\x00',
+    'text': lambda v: str(v).encode('utf-8'),
+    'varchar': lambda v: str(v).encode('utf-8'),
+    'bpchar': lambda v: str(v).encode('utf-8'),
+    'bytea': lambda v: bytes(v),
+    'date': lambda v: struct.pack('!i', _pg_date_days(v)),
+    'timestamp': lambda v: struct.pack('!q', _pg_timestamp_micros(v)),
+    'timestamptz': lambda v: struct.pack('!q', _pg_timestamp_micros(v)),
+    'time': lambda v: struct.pack('!q', _pg_time_micros(v)),
+    'numeric': _pg_numeric,
+}
+
+
+def _get_column_types(conn, table_name, schema='public'):
+    rows = conn.execute(text("""
+        SELECT column_name, udt_name
+        FROM information_schema.columns
+        WHERE table_name = :table_name AND table_schema = :schema
+    """), {'table_name': table_name, 'schema': schema}).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def _get_binary_encoders(conn, table_name, columns, schema='public'):
+    column_types = _get_column_types(conn, table_name, schema)
+
+    encoders = []
+    for column in columns:
+        type_name = column_types.get(column)
+        if type_name not in _COPY_BINARY_ENCODERS:
+            raise ValueError(f"Binary COPY does not support column '{column}' of type {type_name} "
+                             f"in table '{table_name}'. Use copy_format: text instead.")
+        encoders.append(_COPY_BINARY_ENCODERS[type_name])
+    return encoders
+
+
+def _write_copy_binary(df, buffer, encoders):
+    buffer.write(_COPY_BINARY_HEADER)
+    field_count = struct.pack('!h', len(encoders))
+    for row in df.itertuples(index=False, name=None):
+        buffer.write(field_count)
+        for value, encode in zip(row, encoders):
+            if _is_null(value):
+                buffer.write(_COPY_BINARY_NULL)
+            else:
+                data = encode(value)
+                buffer.write(struct.pack('!i', len(data)))
+                buffer.write(data)
+    buffer.write(struct.pack('!h', -1))
+
+
+def _copy_from_buffer(dbapi_cursor, sql, buffer):
+    buffer.seek(0)
+    if hasattr(dbapi_cursor, 'copy_expert'):  # psycopg2
+        dbapi_cursor.copy_expert(sql, buffer)
+    else:  # psycopg 3
+        with dbapi_cursor.copy(sql) as copy:
+            copy.write(buffer.getvalue())
+
+
+# Bulk load a DataFrame (or an iterable of DataFrame batches) with COPY ... FROM STDIN.
+# Keeps the create-if-missing + TRUNCATE semantics of sync_to_postgres; every batch is
+# serialised into an in-memory buffer and streamed to the server on its own.
+# copy_format is either 'text' or 'binary'. Returns the number of rows loaded.
+def copy_to_postgres(data, table_name, engine, copy_format='text', unlogged=False):
+    if copy_format not in ('text', 'binary'):
+        raise ValueError(f"Unsupported copy_format '{copy_format}'. Supported formats are text, binary.")
+
+    batches = iter([data] if isinstance(data, pd.DataFrame) else data)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        return 0
+
+    columns = list(first_batch.columns)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    sql = f'COPY "{table_name}" ({column_list}) FROM STDIN WITH (FORMAT {copy_format})'
+
+    row_count = 0
+    with engine.begin() as conn:
+        apply_session_settings(conn)
+        prepare_target_table(conn, first_batch, table_name, unlogged)
+        if copy_format == 'binary':
+            encoders = _get_binary_encoders(conn, table_name, columns)
+        else:
+            converters = _get_text_converters(conn, table_name, columns)
+
+        dbapi_cursor = conn.connection.cursor()
+        try:
+            batch = first_batch
+            while batch is not None:
+                if copy_format == 'binary':
+                    buffer = io.BytesIO()
+                    _write_copy_binary(batch, buffer, encoders)
+                else:
+                    buffer = io.StringIO()
+                    _write_copy_text(batch, buffer, converters)
+                add_to_stage(bytes=buffer.tell())
+                _copy_from_buffer(dbapi_cursor, sql, buffer)
+                row_count += len(batch)
+                batch = next(batches, None)
+        finally:
+            dbapi_cursor.close()
+        logger.info(f"Copied {row_count} rows into PostgreSQL table '{table_name}' ({copy_format} COPY)")
+    return row_count
+
+
+# Load a DataFrame or an iterable of DataFrame batches with the configured load method:
+# 'to_sql' (DataFrame.to_sql INSERTs) or 'copy' (COPY ... FROM STDIN). A table the load
+# has to create is created UNLOGGED when unlogged is set. Returns the number of rows loaded.
+def load_to_postgres(data, table_name, engine, load_method='to_sql', copy_format='text', unlogged=False):
+    if load_method not in ('to_sql', 'copy'):
+        raise ValueError(f"Unsupported load_method '{load_method}'. Supported methods are to_sql, copy.")
+
+    with stage('postgres_load', table=table_name) as load_stage:
+        if load_method == 'copy':
+            load_stage['rows'] = copy_to_postgres(data, table_name, engine, copy_format, unlogged)
+        elif isinstance(data, pd.DataFrame):
+            sync_to_postgres(data, table_name, engine, unlogged)
+            load_stage['rows'] = len(data)
+        else:
+            load_stage['rows'] = sync_batches_to_postgres(data, table_name, engine, unlogged)
+    return load_stage['rows']
+
+
+# Look up a per-query option, falling back to the flow-wide `etl` section of config.yaml
+def query_option(item, etl_cfg, key, default=None):
+    if key in item:
+        return item[key]
+    return (etl_cfg or {}).get(key, default)
+
+
+# Run the configured query and return its rows, either as one DataFrame or as a generator
+# of DataFrame batches when fetch_batch_size is set. Returns None when no rows came back.
+# Queries with a `partition` section are extracted in date-range partitions on their own
+# connections (see PartitionedExtract), which needs the Sybase connection settings.
+def extract_query_data(cursor, item, etl_cfg=None, sybase_config=None):
+    if item.get('partition'):
+        if sybase_config is None:
+            raise ValueError(f"Partitioned extraction of {item['name']} needs the Sybase connection settings.")
+        return PartitionedExtract(item, sybase_config, etl_cfg)
+
+    fetch_batch_size = query_option(item, etl_cfg, 'fetch_batch_size')
+    materialize = query_option(item, etl_cfg, 'materialize')
+    if fetch_batch_size:
+        batches = iter_sybase_query_batches(cursor, item, int(fetch_batch_size), materialize)
+        pipeline_queue_size = query_option(item, etl_cfg, 'pipeline_queue_size')
+        if pipeline_queue_size:
+            # Fetch on a background thread while the loader writes the previous batches
+            batches = prefetch_batches(batches, int(pipeline_queue_size))
+        return batches
+
+    df = execute_sybase_query(cursor, item, materialize)
+    return None if df.empty else df
+
+
+# ---- Date-range partitioned extraction ----
+
+# Split the inclusive date range [start, end] at day, week (Monday) or month boundaries.
+# Returns a list of inclusive (from, to) date pairs.
+def split_date_range(start, end, by='month'):
+    if by not in ('day', 'week', 'month'):
+        raise ValueError(f"Unsupported partition unit '{by}'. Supported units are day, week, month.")
+
+    ranges = []
+    current = start
+    while current <= end:
+        if by == 'day':
+            next_start = current + datetime.timedelta(days=1)
+        elif by == 'week':
+            next_start = current + datetime.timedelta(days=7 - current.weekday())
+        else:
+            next_start = (current.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        ranges.append((current, min(next_start - datetime.timedelta(days=1), end)))
+        current = next_start
+    return ranges
+
+
+# One query item per date-range partition of item. Procedures get the sub-range in the
+# from/to positions of their arguments (partition.date_arguments, default [0, 1]), inclusive
+# like the full range they were configured with; views get a half-open
+# "<partition.column> >= ? AND <partition.column> < ?" filter bounded by the next sub-range's
+# start, so timestamps later in a sub-range's last day are not lost, ANDed with any existing filter.
+def partition_query_items(item):
+    partition = item['partition']
+    by = partition.get('by', 'month')
+    date_format = partition.get('date_format', '%Y-%m-%d')
+    from_index, to_index = partition.get('date_arguments', [0, 1])
+
+    if item['type'].lower() == 'view':
+        if 'column' not in partition:
+            raise ValueError(f"Partitioned view {item['name']} needs partition.column.")
+        start, end = partition['from'], partition['to']
+    else:
+        arguments = item.get('arguments', [])
+        start, end = arguments[from_index], arguments[to_index]
+    try:
+        start = datetime.datetime.strptime(str(start), date_format).date()
+        end = datetime.datetime.strptime(str(end), date_format).date()
+    except ValueError as e:
+        raise ValueError(f"Cannot partition {item['name']}: {e}") from e
+
+    items = []
+    for sub_from, sub_to in split_date_range(start, end, by):
+        run_item = {key: value for key, value in item.items() if key != 'partition'}
+        if item['type'].lower() == 'view':
+            condition = f"\"{partition['column']}\" >= ? AND \"{partition['column']}\" < ?"
+            run_item['filter'] = f"({item['filter']}) AND {condition}" if item.get('filter') else condition
+            run_item['arguments'] = list(item.get('arguments', [])) + [sub_from, sub_to + datetime.timedelta(days=1)]
+        else:
+            run_item['arguments'] = list(item.get('arguments', []))
+            run_item['arguments'][from_index] = sub_from.strftime(date_format)
+            run_item['arguments'][to_index] = sub_to.strftime(date_format)
+        items.append(run_item)
+    return items
+
+
+# Batches of a date-range partitioned extract. Every sub-range runs on its own Sybase
+# connection, partition.workers of them at a time, and their batches come out of this one
+# iterable so they are loaded into a single target in one transaction. With
+# partition.ordered the batches follow sub-range order (later sub-ranges wait, holding up
+# to partition.queue_size batches each); otherwise they are passed on as they arrive.
+# `description` is the cursor.description of the first result set, once a batch arrived.
+class PartitionedExtract:
+    def __init__(self, item, sybase_config, etl_cfg=None):
+        partition = item['partition']
+        self.item = item
+        self.items = partition_query_items(item)
+        self.sybase_config = sybase_config
+        self.etl_cfg = etl_cfg
+        self.workers = max(1, min(int(partition.get('workers', 4)), len(self.items)))
+        self.ordered = bool(partition.get('ordered', False))
+        self.queue_size = int(partition.get('queue_size', 2))
+        self.description = None
+        self._stop = threading.Event()
+        self._done = object()
+
+    def _put(self, batch_queue, entry):
+        while not self._stop.is_set():
+            try:
+                batch_queue.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _extract(self, run_item, batch_queue):
+        sybase_conn = cursor = None
+        try:
+            sybase_conn = get_sybase_connection(self.sybase_config)
+            cursor = sybase_conn.cursor()
+            data = extract_query_data(cursor, run_item, self.etl_cfg)
+            batches = [] if data is None else [data] if isinstance(data, pd.DataFrame) else data
+            for batch in batches:
+                if self.description is None:
+                    self.description = cursor.description
+                if not self._put(batch_queue, batch):
+                    return
+        except BaseException as e:
+            self._put(batch_queue, _ProducerError(e))
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if sybase_conn is not None:
+                sybase_conn.close()
+            self._put(batch_queue, self._done)
+
+    def __iter__(self):
+        logger.info(f"Extracting {self.item['name']} in {len(self.items)} date-range partitions "
+                    f"on {self.workers} connections{' (ordered)' if self.ordered else ''}")
+        if self.ordered:
+            queues = [queue.Queue(maxsize=self.queue_size) for _ in self.items]
+        else:
+            queues = [queue.Queue(maxsize=self.queue_size * self.workers)] * len(self.items)
+
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sybase-partition")
+        try:
+            for run_item, batch_queue in zip(self.items, queues):
+                executor.submit(self._extract, run_item, batch_queue)
+
+            # Ordered: drain the partitions one after the other. Unordered: every partition
+            # writes to the same queue, which is drained until all of them are done.
+            pending = len(self.items)
+            index = 0
+            while pending:
+                entry = queues[index].get()
+                if entry is self._done:
+                    pending -= 1
+                    index += 1 if self.ordered else 0
+                    continue
+                if isinstance(entry, _ProducerError):
+                    raise entry.error
+                yield entry
+        finally:
+            self._stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# ---- Parquet staging between extract and load ----
+
+# Arrow schema for the staging file. Typed columns keep the type pandas gave them; object
+# columns (decimals, all-NULL columns, ...) take their type from cursor.description, and so
+# do date columns, which pandas holds as datetime64 and would be staged as timestamps.
+def staging_schema(first_batch, description):
+    import pyarrow as pa
+
+    inferred = pa.Schema.from_pandas(_without_attrs(first_batch), preserve_index=False)
+    fields = []
+    for field, desc in zip(inferred, description):
+        if first_batch[field.name].dtype == object or (desc[1] is datetime.date and pa.types.is_timestamp(field.type)):
+            arrow_type = arrow_type_for(pa, desc[1], desc[4], desc[5])
+            if arrow_type is not None:
+                field = pa.field(field.name, arrow_type)
+        fields.append(field)
+    return pa.schema(fields)
+
+
+# The column types in df.attrs['sql_types'] are carried by the Arrow schema of the staging
+# file; pyarrow would otherwise try (and fail) to store them as JSON pandas metadata
+def _without_attrs(df):
+    if not df.attrs:
+        return df
+    df = df.copy(deep=False)
+    df.attrs = {}
+    return df
+
+
+# Write extracted data (a DataFrame or DataFrame batches) to a Parquet snapshot, one row
+# group per batch. The file is written under a temporary name and renamed when complete.
+# Returns the number of rows written; no file is left behind when there are none.
+def write_staging_file(data, file_path, cursor, compression='zstd'):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    batches = iter([data] if isinstance(data, pd.DataFrame) else data)
+    first_batch = next(batches, None)
+    if first_batch is None or first_batch.empty:
+        return 0
+
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    tmp_file = f"{file_path}.tmp"
+    schema = staging_schema(first_batch, cursor.description)     # result is open once a batch arrived
+    row_count = 0
+    try:
+        with stage('staging_write', file=os.path.basename(file_path)) as write_stage:
+            with pq.ParquetWriter(tmp_file, schema, compression=compression) as writer:
+                batch = first_batch
+                while batch is not None:
+                    writer.write_table(pa.Table.from_pandas(_without_attrs(batch), schema=schema, preserve_index=False))
+                    row_count += len(batch)
+                    batch = next(batches, None)
+            write_stage['rows'] = row_count
+            write_stage['bytes'] = os.path.getsize(tmp_file)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, file_path)
+    logger.info(f"Staged {row_count} rows in {file_path}")
+    return row_count
+
+
+# Read a staging file back: one DataFrame, or a generator of batch_size-row batches.
+# NumPy-backed batches get the decimal and date column types of the file's schema in
+# df.attrs['sql_types'], as materialize_rows gives them.
+def read_staging_file(file_path, batch_size=None, materialize=None):
+    import pyarrow.parquet as pq
+
+    types_mapper = pd.ArrowDtype if materialize == 'arrow' else None
+
+    def to_pandas(table):
+        df = table.to_pandas(types_mapper=types_mapper)
+        if types_mapper is None:
+            df.attrs['sql_types'] = arrow_schema_sql_types(table.schema)
+        return df
+
+    if not batch_size:
+        return to_pandas(pq.read_table(file_path))
+    parquet_file = pq.ParquetFile(file_path)
+    return (to_pandas(batch) for batch in parquet_file.iter_batches(batch_size=batch_size))
+
+
+# Load a staging file into table_name. A failed load is rolled back by its transaction and
+# retried from the file (load_retries times, load_retry_delay seconds apart), so Sybase is
+# not queried again. Returns the number of rows loaded.
+def load_staging_file(file_path, table_name, engine, item, etl_cfg=None, unlogged=False):
+    load_method = query_option(item, etl_cfg, 'load_method', 'to_sql')
+    copy_format = query_option(item, etl_cfg, 'copy_format', 'text')
+    fetch_batch_size = query_option(item, etl_cfg, 'fetch_batch_size')
+    materialize = query_option(item, etl_cfg, 'materialize')
+    load_retries = int(query_option(item, etl_cfg, 'load_retries', 0))
+    load_retry_delay = float(query_option(item, etl_cfg, 'load_retry_delay', 10))
+
+    attempt = 0
+    while True:
+        try:
+            data = read_staging_file(file_path, int(fetch_batch_size) if fetch_batch_size else None, materialize)
+            return load_to_postgres(data, table_name, engine, load_method, copy_format, unlogged)
+        except Exception as e:
+            if attempt >= load_retries:
+                raise
+            attempt += 1
+            logger.warning(f"Load of '{table_name}' failed: {e}. Retrying from {file_path} "
+                           f"in {load_retry_delay}s (attempt {attempt} of {load_retries})")
+            time.sleep(load_retry_delay)
+
+
+# Load extracted data into table_name, through a Parquet snapshot in staging_dir when one
+# is configured (named after staging_name, default table_name). before_load, if given, runs
+# right before PostgreSQL is touched, i.e. after the staging file has been written.
+# Returns the number of rows loaded.
+def load_query_data(cursor, data, table_name, engine, item, etl_cfg=None, staging_name=None, unlogged=False,
+                    before_load=None):
+    staging_dir = query_option(item, etl_cfg, 'staging_dir')
+    if not staging_dir:
+        load_method = query_option(item, etl_cfg, 'load_method', 'to_sql')
+        copy_format = query_option(item, etl_cfg, 'copy_format', 'text')
+        if before_load:
+            before_load()
+        return load_to_postgres(data, table_name, engine, load_method, copy_format, unlogged)
+
+    staging_file = os.path.join(staging_dir, f"{staging_name or table_name}.parquet")
+    compression = query_option(item, etl_cfg, 'staging_compression', 'zstd')
+    # A partitioned extract carries the result description itself; its connections are its own
+    result = data if isinstance(data, (PartitionedExtract, FingerprintedBatches)) else cursor
+    if not write_staging_file(data, staging_file, result, compression):
+        return 0
+    if before_load:
+        before_load()
+    return load_staging_file(staging_file, table_name, engine, item, etl_cfg, unlogged)
+
+
+# ---- Content fingerprints for skipping unchanged loads ----
+
+# pyodbc returns binary/varbinary/image values as bytearray, which hash_pandas_object cannot
+# hash; object columns holding them are hashed as bytes instead
+def _hashable_frame(df):
+    converted = {}
+    for position, dtype in enumerate(df.dtypes):
+        if dtype == object:
+            values = df.iloc[:, position]
+            if any(isinstance(value, (bytearray, memoryview)) for value in values):
+                converted[position] = values.map(
+                    lambda value: bytes(value) if isinstance(value, (bytearray, memoryview)) else value)
+    if not converted:
+        return df
+    df = df.copy(deep=False)
+    for position, values in converted.items():
+        df.isetitem(position, values)
+    return df
+
+
+# Fingerprint of extracted data, computed batch by batch while it streams to the loader: a
+# rolling SHA-256 over the pandas row hashes of every batch, plus a short digest per batch
+# (chunk). Rows are hashed in arrival order, so unordered partitioned extracts rarely match.
+# `previous` is the query's entry of the state file.
+class DataFingerprint:
+    def __init__(self, previous=None):
+        self.previous = previous or {}
+        self.rows = 0
+        self.chunks = []
+        self._digest = hashlib.sha256()
+        self._columns = None
+
+    def update(self, df):
+        if self._columns is None:
+            self._columns = [str(column) for column in df.columns]
+            self._digest.update(json.dumps(self._columns).encode())
+        row_hashes = pd.util.hash_pandas_object(_hashable_frame(df), index=False).to_numpy().tobytes()
+        self._digest.update(row_hashes)
+        self.chunks.append(hashlib.sha256(row_hashes).hexdigest()[:16])
+        self.rows += len(df)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def matches_previous(self):
+        return self.rows > 0 and self.previous.get('fingerprint') == self.hexdigest()
+
+    def changed_chunks(self):
+        previous_chunks = self.previous.get('chunks', [])
+        return sum(1 for index, chunk in enumerate(self.chunks)
+                   if index >= len(previous_chunks) or previous_chunks[index] != chunk)
+
+    def state(self):
+        return {
+            'fingerprint': self.hexdigest(), 'chunks': self.chunks, 'rows': self.rows,
+            'changed_at': datetime.datetime.now().isoformat(),
+        }
+
+
+class UnchangedDataError(Exception):
+    pass
+
+
+# Batches passed through a DataFingerprint. Once the last batch has been handed out,
+# UnchangedDataError is raised when the data matches the previous run, so the load is
+# rolled back by its transaction (or the staging file / shadow table is discarded).
+# `description` comes from source, the cursor or partitioned extract the batches come from.
+class FingerprintedBatches:
+    def __init__(self, batches, fingerprint, source):
+        self.batches = batches
+        self.fingerprint = fingerprint
+        self.source = source
+
+    @property
+    def description(self):
+        return self.source.description
+
+    def __iter__(self):
+        for batch in self.batches:
+            self.fingerprint.update(batch)
+            yield batch
+        if self.fingerprint.matches_previous():
+            raise UnchangedDataError(f"{self.fingerprint.rows} rows unchanged since the previous run")
+
+
+# ---- Shadow-table load with an atomic swap ----
+
+SHADOW_SUFFIX = '__shadow'
+OLD_SUFFIX = '__old'
+
+
+# Table or index name with a suffix, cut to PostgreSQL's 63 character limit
+def suffixed_name(name, suffix):
+    return f"{name[:63 - len(suffix)]}{suffix}"
+
+
+def table_exists(conn, table_name, schema='public'):
+    return conn.execute(text("SELECT to_regclass(:name)"), {'name': f'"{schema}"."{table_name}"'}).scalar() is not None
+
+
+# A table can only be swapped when no view depends on it: views follow the renamed table,
+# so they would keep reading the old data and block its drop.
+def can_swap_table(engine, table_name, schema='public'):
+    with engine.connect() as conn:
+        dependent_view = conn.execute(text("""
+            SELECT r.ev_class::regclass::text
+            FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE d.refobjid = to_regclass(:name) AND r.ev_class <> d.refobjid
+            LIMIT 1
+        """), {'name': f'"{schema}"."{table_name}"'}).scalar()
+    if dependent_view is not None:
+        logger.warning(f"View {dependent_view} depends on '{table_name}'; loading the table in place instead of swapping it")
+        return False
+    return True
+
+
+# Pairs of (live index, shadow index) that LIKE ... INCLUDING INDEXES copied, matched on
+# their definition since the copies get generated names. The flag tells whether the copy
+# backs a constraint (primary key, unique or exclusion constraint).
+def _copied_index_pairs(conn, table_name, shadow_table, schema='public'):
+    rows = conn.execute(text("""
+        SELECT lc.relname, sc.relname, EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = s.indexrelid)
+        FROM pg_index l
+        JOIN pg_index s ON s.indrelid = to_regclass(:shadow)
+            AND s.indkey = l.indkey AND s.indclass = l.indclass AND s.indisunique = l.indisunique
+            AND coalesce(pg_get_expr(s.indexprs, s.indrelid), '') = coalesce(pg_get_expr(l.indexprs, l.indrelid), '')
+            AND coalesce(pg_get_expr(s.indpred, s.indrelid), '') = coalesce(pg_get_expr(l.indpred, l.indrelid), '')
+        JOIN pg_class lc ON lc.oid = l.indexrelid
+        JOIN pg_class sc ON sc.oid = s.indexrelid
+        WHERE l.indrelid = to_regclass(:live)
+        ORDER BY lc.relname, sc.relname
+    """), {'live': f'"{schema}"."{table_name}"', 'shadow': f'"{schema}"."{shadow_table}"'}).fetchall()
+
+    pairs, used = [], set()
+    for live_index, shadow_index, backs_constraint in rows:
+        if live_index not in used and shadow_index not in used:
+            used.update((live_index, shadow_index))
+            pairs.append((live_index, shadow_index, backs_constraint))
+    return pairs
+
+
+# Create an empty UNLOGGED copy of table_name (columns, defaults, constraints, indexes and
+# the grants of its readers) to load into. Identity columns get their own sequence, set to
+# where the live one stands; serial columns keep their nextval() defaults on the live table's
+# sequences, which the swap hands over (see _move_owned_sequences). Indexes that are not
+# configured in index_columns are kept under "<index>__shadow" so the swap can give them their
+# names back; copies of the configured ones are dropped and built after the load. Returns False
+# when table_name does not exist yet; the shadow table is then created (UNLOGGED) by the first
+# load, from the data.
+def prepare_shadow_table(engine, table_name, shadow_table, index_definitions=(), schema='public'):
+    configured = {definition['name'] for definition in index_definitions}
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{shadow_table}"'))  # left over by a failed run
+        clear_index_cache(shadow_table, schema)
+        if not table_exists(conn, table_name, schema):
+            return False
+
+        conn.execute(text(f"""
+            CREATE UNLOGGED TABLE "{schema}"."{shadow_table}"
+            (LIKE "{schema}"."{table_name}" INCLUDING ALL)
+        """))
+        for column, sequence, deptype in _owned_sequences(conn, table_name, schema):
+            if deptype == 'i':
+                conn.execute(text(f"""
+                    SELECT setval(pg_get_serial_sequence(:shadow, :column), last_value, is_called) FROM {sequence}
+                """), {'shadow': f'"{schema}"."{shadow_table}"', 'column': column})
+        for live_index, shadow_index, backs_constraint in _copied_index_pairs(conn, table_name, shadow_table, schema):
+            if live_index in configured and not backs_constraint:
+                conn.execute(text(f'DROP INDEX "{schema}"."{shadow_index}"'))
+            else:
+                conn.execute(text(f'ALTER INDEX "{schema}"."{shadow_index}" '
+                                  f'RENAME TO "{suffixed_name(live_index, SHADOW_SUFFIX)}"'))
+        clear_index_cache(shadow_table, schema)
+
+        grants = conn.execute(text("""
+            SELECT grantee, string_agg(privilege_type, ', ')
+            FROM information_schema.table_privileges
+            WHERE table_schema = :schema AND table_name = :table_name AND grantee <> current_user
+            GROUP BY grantee
+        """), {'schema': schema, 'table_name': table_name}).fetchall()
+        for grantee, privileges in grants:
+            role = grantee if grantee == 'PUBLIC' else f'"{grantee}"'
+            conn.execute(text(f'GRANT {privileges} ON "{schema}"."{shadow_table}" TO {role}'))
+    return True
+
+
+# Sequences owned by columns of table_name: serial (and OWNED BY) sequences, deptype 'a',
+# and identity sequences, deptype 'i'
+def _owned_sequences(conn, table_name, schema='public'):
+    return conn.execute(text("""
+        SELECT a.attname, d.objid::regclass::text, d.deptype
+        FROM pg_depend d
+        JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.classid = 'pg_class'::regclass AND d.refobjid = to_regclass(:name) AND d.deptype IN ('a', 'i')
+    """), {'name': f'"{schema}"."{table_name}"'}).fetchall()
+
+
+# Re-own the serial sequences of the table being replaced by the table swapped in (whose
+# defaults already call them), so dropping the old table neither fails on nor takes along the
+# sequences the new one still uses. Identity sequences already belong to the shadow table.
+def _move_owned_sequences(conn, sequences, table_name, schema='public'):
+    for column, sequence, deptype in sequences:
+        if deptype == 'a':
+            conn.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY "{schema}"."{table_name}"."{column}"'))
+
+
+def drop_table_async(engine, table_name, schema='public'):
+    def drop():
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{table_name}"'))
+            logger.info(f"Dropped PostgreSQL table '{table_name}'")
+        except Exception as e:
+            logger.warning(f"Could not drop PostgreSQL table '{table_name}': {e}")
+
+    thread = threading.Thread(target=drop, name=f"drop-{table_name}")
+    thread.start()
+    return thread
+
+
+# Put shadow_table in the place of table_name with renames in one short transaction. The
+# indexes and sequences move along: the live indexes are renamed to <name>__old and the shadow
+# ones (configured or carried over by prepare_shadow_table) take their names. The transaction gives up after lock_timeout when readers hold the
+# table and is retried up to `retries` times. The old table is dropped on a background thread.
+def swap_shadow_table(engine, table_name, shadow_table, index_definitions, schema='public', lock_timeout='5s', retries=3):
+    old_table = suffixed_name(table_name, OLD_SUFFIX)
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{old_table}"'))  # left over by a failed drop
+
+    attempt = 0
+    while True:
+        try:
+            with stage('table_swap', table=table_name), engine.begin() as conn:
+                conn.execute(text("SELECT set_config('lock_timeout', :timeout, true)"), {'timeout': str(lock_timeout)})
+                replaced = table_exists(conn, table_name, schema)
+                live_indexes = []
+                sequences = []
+                if replaced:
+                    sequences = _owned_sequences(conn, table_name, schema)
+                    live_indexes = [row[0] for row in conn.execute(text(
+                        "SELECT indexname FROM pg_indexes WHERE tablename = :table_name AND schemaname = :schema"
+                    ), {'table_name': table_name, 'schema': schema})]
+                    conn.execute(text(f'ALTER TABLE "{schema}"."{table_name}" RENAME TO "{old_table}"'))
+                    for index_name in live_indexes:
+                        conn.execute(text(f'ALTER INDEX "{schema}"."{index_name}" '
+                                          f'RENAME TO "{suffixed_name(index_name, OLD_SUFFIX)}"'))
+                conn.execute(text(f'ALTER TABLE "{schema}"."{shadow_table}" RENAME TO "{table_name}"'))
+                _move_owned_sequences(conn, sequences, table_name, schema)
+                index_names = live_indexes + [definition['name'] for definition in index_definitions
+                                              if definition['name'] not in live_indexes]
+                for index_name in index_names:
+                    conn.execute(text(f'ALTER INDEX IF EXISTS "{schema}"."{suffixed_name(index_name, SHADOW_SUFFIX)}" '
+                                      f'RENAME TO "{index_name}"'))
+            break
+        except sqlalchemy.exc.OperationalError as e:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            logger.warning(f"Swap of '{table_name}' failed: {e}. Retrying (attempt {attempt} of {retries})")
+            time.sleep(attempt)
+        finally:
+            for name in (table_name, shadow_table, old_table):
+                clear_index_cache(name, schema)
+
+    logger.info(f"Swapped the new data into PostgreSQL table '{table_name}'")
+    if replaced:
+        drop_table_async(engine, old_table, schema)
+
+
+# load_mode 'swap': load into an UNLOGGED "<table_name>__shadow" table, build the configured
+# indexes on it and swap it in, so readers of table_name are only blocked for the renames
+# instead of the whole TRUNCATE and reload. Returns the number of rows loaded.
+def swap_load_query(cursor, data, table_name, engine, item, etl_cfg=None):
+    shadow_table = suffixed_name(table_name, SHADOW_SUFFIX)
+    index_definitions = normalize_index_definitions(item.get('index_columns', []), item.get('index_prefix', 'idx'))
+    shadow_indexes = [
+        dict(definition, name=suffixed_name(definition['name'], SHADOW_SUFFIX)) for definition in index_definitions
+    ]
+
+    prepare_shadow_table(engine, table_name, shadow_table, index_definitions)
+    try:
+        row_count = load_query_data(cursor, data, shadow_table, engine, item, etl_cfg,
+                                    staging_name=table_name, unlogged=True)
+        if row_count:
+            create_indexes(engine, shadow_table, shadow_indexes, item.get('index_prefix', 'idx'))
+            if query_option(item, etl_cfg, 'shadow_logged', False):
+                with engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE "{shadow_table}" SET LOGGED'))
+            swap_shadow_table(engine, table_name, shadow_table, index_definitions,
+                              lock_timeout=query_option(item, etl_cfg, 'swap_lock_timeout', '5s'),
+                              retries=int(query_option(item, etl_cfg, 'swap_retries', 3)))
+    except Exception:
+        drop_table_async(engine, shadow_table)
+        raise
+
+    if not row_count:
+        drop_table_async(engine, shadow_table)   # keep the live table when nothing came back
+    return row_count
+
+
+# Extract one configured query from Sybase and load it into its PostgreSQL target table.
+# Returns the number of rows loaded (0 means nothing was returned).
+def extract_and_sync_query(cursor, item, postgres_engine, etl_cfg=None, sybase_config=None):
+    if item.get('incremental'):
+        return extract_and_upsert_query(cursor, item, postgres_engine, etl_cfg, sybase_config)
+
+    target_table = item.get('target_table', item['name'])  # fallback to source name
+    load_mode = query_option(item, etl_cfg, 'load_mode', 'truncate')
+    if load_mode not in ('truncate', 'swap'):
+        raise ValueError(f"Unsupported load_mode '{load_mode}'. Supported modes are truncate, swap.")
+
+    data = extract_query_data(cursor, item, etl_cfg, sybase_config)
+    if data is None:
+        return 0
+
+    # skip_unchanged: fingerprint the data and leave the table (and its indexes) alone when
+    # it matches the fingerprint stored by the previous load
+    fingerprint = None
+    if query_option(item, etl_cfg, 'skip_unchanged', False):
+        state_file = query_option(item, etl_cfg, 'state_file', DEFAULT_STATE_FILE)
+        fingerprint = DataFingerprint(load_etl_state(state_file).get(target_table))
+        if isinstance(data, pd.DataFrame):
+            fingerprint.update(data)
+            if fingerprint.matches_previous():
+                logger.info(f"Data of {item['name']} is unchanged since the previous run. Skipping the load of '{target_table}'")
+                return len(data)
+        else:
+            data = FingerprintedBatches(data, fingerprint, data if isinstance(data, PartitionedExtract) else cursor)
+
+    try:
+        if load_mode == 'swap' and can_swap_table(postgres_engine, target_table):
+            row_count = swap_load_query(cursor, data, target_table, postgres_engine, item, etl_cfg)
+        else:
+            # Deferred index builds drop the indexes only once the data is known to have changed.
+            # A streamed load without staging_dir only knows that after loading it (rolled back
+            # when unchanged), so it keeps the indexes during the load.
+            before_load = lambda: drop_query_indexes(postgres_engine, item, etl_cfg)
+            if isinstance(data, FingerprintedBatches) and not query_option(item, etl_cfg, 'staging_dir'):
+                before_load = None
+            row_count = load_query_data(cursor, data, target_table, postgres_engine, item, etl_cfg,
+                                        before_load=before_load)
+            if row_count:
+                create_query_indexes(postgres_engine, item, etl_cfg)
+    except UnchangedDataError:
+        logger.info(f"Data of {item['name']} is unchanged since the previous run. '{target_table}' was left as it was")
+        return fingerprint.rows
+
+    if fingerprint is not None and row_count:
+        logger.info(f"{fingerprint.changed_chunks()} of {len(fingerprint.chunks)} chunks of {item['name']} changed")
+        update_etl_state(state_file, target_table, fingerprint.state())
+    return row_count
+
+
+# ---- Watermark-based incremental extraction ----
+
+def load_etl_state(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+# Update one entry of the state file. The file is rewritten atomically so an interrupted
+# run never leaves a half-written state behind.
+def update_etl_state(state_file, key, values):
+    with _state_lock:
+        state = load_etl_state(state_file)
+        state.setdefault(key, {}).update(values)
+        tmp_file = f"{state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2, default=str)
+        os.replace(tmp_file, state_file)
+
+
+# Return a copy of the query item that only asks Sybase for rows past the watermark.
+# Procedures get the watermark through '{watermark}' placeholders in their arguments,
+# views get a "<watermark_column> > ?" filter.
+def incremental_query_item(item, watermark):
+    incremental = item['incremental']
+    run_item = dict(item)
+    if watermark is None:  # first run without an initial_watermark: full extract
+        return run_item
+
+    if item['type'].lower() == 'view':
+        run_item['filter'] = f"\"{incremental['watermark_column']}\" > ?"
+        run_item['arguments'] = [watermark]
+    else:
+        arguments = incremental.get('arguments', item.get('arguments', []))
+        run_item['arguments'] = [
+            arg.replace('{watermark}', str(watermark)) if isinstance(arg, str) else arg
+            for arg in arguments
+        ]
+    return run_item
+
+
+# Merge the rows of delta_table into target_table: insert new keys, update existing ones.
+# Returns the highest watermark_column value found in the delta.
+def upsert_from_delta(engine, delta_table, target_table, key_columns, watermark_column, index_prefix, schema='public'):
+    with engine.begin() as conn:
+        apply_session_settings(conn)
+        columns = [row[0] for row in conn.execute(text("""
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_name = :table_name AND table_schema = :schema
+            ORDER BY ordinal_position
+        """), {'table_name': delta_table, 'schema': schema}).fetchall()]
+
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{schema}"."{target_table}" (LIKE "{schema}"."{delta_table}")'))
+
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        if key_columns:
+            key_list = ", ".join(f'"{column}"' for column in key_columns)
+            # ON CONFLICT needs a unique index on the key columns
+            key_index = build_index_name(index_prefix, "_".join(key_columns), 'key')
+            conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS "{key_index}" ON "{schema}"."{target_table}" ({key_list})'))
+
+            update_columns = [column for column in columns if column not in key_columns]
+            if update_columns:
+                conflict_action = "DO UPDATE SET " + ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in update_columns)
+            else:
+                conflict_action = "DO NOTHING"
+
+            # A key may appear more than once in the delta; keep its latest version only
+            result = conn.execute(text(f"""
+                INSERT INTO "{schema}"."{target_table}" ({column_list})
+                SELECT DISTINCT ON ({key_list}) {column_list}
+                FROM "{schema}"."{delta_table}"
+                ORDER BY {key_list}, "{watermark_column}" DESC
+                ON CONFLICT ({key_list}) {conflict_action}
+            """))
+        else:
+            result = conn.execute(text(f"""
+                INSERT INTO "{schema}"."{target_table}" ({column_list})
+                SELECT {column_list} FROM "{schema}"."{delta_table}"
+            """))
+        logger.info(f"Upserted {result.rowcount} rows from '{delta_table}' into PostgreSQL table '{target_table}'")
+
+        return conn.execute(text(f'SELECT MAX("{watermark_column}") FROM "{schema}"."{delta_table}"')).scalar()
+
+
+# Incremental counterpart of extract_and_sync_query: extracts only rows past the stored
+# high-water mark, loads them into a "<target_table>__delta" table and upserts them into
+# the target table. The new mark is persisted once the upsert has been committed.
+# Returns the number of delta rows extracted.
+def extract_and_upsert_query(cursor, item, postgres_engine, etl_cfg=None, sybase_config=None):
+    incremental = item['incremental']
+    target_table = item.get('target_table', item['name'])  # fallback to source name
+    delta_table = f"{target_table}__delta"
+    state_file = query_option(item, etl_cfg, 'state_file', DEFAULT_STATE_FILE)
+
+    watermark = load_etl_state(state_file).get(target_table, {}).get('watermark', incremental.get('initial_watermark'))
+    logger.info(f"Incremental extract of {item['name']} from watermark {watermark}")
+
+    data = extract_query_data(cursor, incremental_query_item(item, watermark), etl_cfg, sybase_config)
+    if data is None:
+        return 0
+
+    row_count = load_query_data(cursor, data, delta_table, postgres_engine, item, etl_cfg)
+    if not row_count:
+        return 0
+
+    drop_query_indexes(postgres_engine, item, etl_cfg)
+    new_watermark = upsert_from_delta(
+        postgres_engine, delta_table, target_table,
+        incremental.get('key_columns', []), incremental['watermark_column'], item.get('index_prefix', 'idx')
+    )
+    if new_watermark is not None:
+        update_etl_state(state_file, target_table, {'watermark': new_watermark})
+        logger.info(f"Watermark for {target_table} moved to {new_watermark}")
+
+    create_query_indexes(postgres_engine, item, etl_cfg)
+    return row_count
+
 def main():
     config = load_config()
+    clear_index_cache()
     # print(pyodbc.drivers());
     sybase_conn = get_sybase_connection(config['sybase'])
     postgres_engine = get_postgres_engine(config['postgres'])
 
     cursor = sybase_conn.cursor()
-    
+    etl_cfg = config.get('etl', {})
+    # Procedures start as soon as the tables they depend on are loaded
+    procedures = ProcedureRunner(postgres_engine, config.get("postgres_procedures", []), config['queries'],
+                                 etl_cfg.get('procedure_workers', 1), etl_cfg)
+
     for item in config['queries']:
         try:
-            df = execute_sybase_query(cursor, item)
-            #print(df.iloc[0])
-            if not df.empty:
-                target_table = item.get('target_table', item['name'])  # fallback to source name
-                sync_to_postgres(df, target_table , postgres_engine)
-                create_indexes(postgres_engine, target_table, item.get('index_columns', []),item.get('index_prefix', 'idx'))
-            else:
+            row_count = extract_and_sync_query(cursor, item, postgres_engine, etl_cfg, config['sybase'])
+            if not row_count:
                 logger.warning(f"No data returned from {item['type']} - {item['name']}")
         except Exception as e:
             logger.error(f"Error processing {item['name']}: {e}")
+        procedures.query_loaded(item)
 
     cursor.close()
     sybase_conn.close()
 
+    if not rebuild_deferred_indexes(postgres_engine, config['queries'], config.get('etl', {})):
+        logger.error("One or more deferred index builds failed.")
+
 # Execute PostgreSQL procedure to load the data from staging to the main table
-    proc_success = execute_postgres_procedures(postgres_engine, config.get("postgres_procedures", []))
+    proc_success = procedures.wait()
 
     if not proc_success:
         logger.error("One or more PostgreSQL procedures failed.")
@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyodbc", exc_type=ImportError)
+import script
+
+
+DESCRIPTION = [
+    ('claim_id', int, None, None, 10, 0, True),
+    ('attachment', bytearray, None, None, None, None, True),
+]
+
+
+def fingerprint_of(*batches):
+    fingerprint = script.DataFingerprint()
+    for batch in batches:
+        fingerprint.update(batch)
+    return fingerprint
+
+
+# pyodbc returns binary/varbinary/image columns as bytearray
+def test_binary_column_is_fingerprinted():
+    df = pd.DataFrame({'claim_id': [1, 2, 3], 'attachment': [bytearray(b'\x00\xff'), None, bytearray(b'pdf')]})
+
+    fingerprint = fingerprint_of(df)
+
+    assert fingerprint.rows == 3
+    assert fingerprint_of(df.copy()).hexdigest() == fingerprint.hexdigest()
+
+
+def test_binary_column_change_is_detected():
+    before = pd.DataFrame({'claim_id': [1, 2], 'attachment': [bytearray(b'a'), bytearray(b'b')]})
+    after = pd.DataFrame({'claim_id': [1, 2], 'attachment': [bytearray(b'a'), bytearray(b'c')]})
+
+    previous = fingerprint_of(before).state()
+    fingerprint = script.DataFingerprint(previous)
+    fingerprint.update(after)
+
+    assert not fingerprint.matches_previous()
+    assert fingerprint.changed_chunks() == 1
+
+
+def test_materialized_binary_column_is_fingerprinted():
+    rows = [(1, bytearray(b'\x01')), (2, None)]
+    df = script.materialize_rows(rows, DESCRIPTION, 'numpy')
+
+    previous = fingerprint_of(df).state()
+    fingerprint = script.DataFingerprint(previous)
+    fingerprint.update(script.materialize_rows(rows, DESCRIPTION, 'numpy'))
+
+    assert fingerprint.matches_previous()
+    assert isinstance(df['attachment'][0], bytearray)     # the loaded data itself is untouched